@@ -1,3 +1,11 @@
 from django.contrib import admin
 
-# Register your models here.
+from .models import ChatRoom
+
+
+@admin.register(ChatRoom)
+class ChatRoomAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'room_type', 'fanout_mode', 'is_active', 'modified')
+    list_filter = ('room_type', 'fanout_mode', 'is_active')
+    search_fields = ('name',)
+    filter_horizontal = ('participants', 'broadcasters')
@@ -0,0 +1,85 @@
+from channels.auth import AuthMiddleware
+from channels.db import database_sync_to_async
+from channels.sessions import CookieMiddleware, SessionMiddleware
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, load_backend
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.utils.crypto import constant_time_compare
+
+from .models import UserProfile
+
+
+def user_cache_key(user_id):
+    return f'chat:auth:user:{user_id}'
+
+
+def invalidate_cached_user(user_id):
+    cache.delete(user_cache_key(user_id))
+
+
+def load_user(backend, user_id):
+    """
+    The user with their profile attached, from the cache when possible
+    """
+    cache_key = user_cache_key(user_id)
+    user = cache.get(cache_key)
+    if user is None:
+        user = backend.get_user(user_id)
+        if user is None:
+            return None
+        # Attach the profile (or its absence) so consumers don't query it;
+        # assigning None to the reverse accessor wouldn't cache the absence
+        profile = UserProfile.objects.filter(user=user).first()
+        if profile is None:
+            UserProfile.user.field.remote_field.set_cached_value(user, None)
+        else:
+            user.profile = profile
+        cache.set(cache_key, user, settings.CHAT_SETTINGS.get('AUTH_CACHE_TIMEOUT', 300))
+    return user
+
+
+def resolve_user(session):
+    """
+    channels.auth.get_user for a loaded session, resolving the user through
+    a short-lived cache. With a cached or signed-cookie session backend a
+    warm handshake does not touch the database.
+    """
+    user = None
+    try:
+        user_id = session[SESSION_KEY]
+        backend_path = session[BACKEND_SESSION_KEY]
+    except KeyError:
+        pass
+    else:
+        if backend_path in settings.AUTHENTICATION_BACKENDS:
+            backend = load_backend(backend_path)
+            user = load_user(backend, user_id)
+            # Verify the session
+            if hasattr(user, 'get_session_auth_hash'):
+                session_hash = session.get(HASH_SESSION_KEY)
+                session_hash_verified = session_hash and constant_time_compare(
+                    session_hash, user.get_session_auth_hash()
+                )
+                if not session_hash_verified:
+                    session.flush()
+                    user = None
+    return user or AnonymousUser()
+
+
+@database_sync_to_async
+def get_cached_user(scope):
+    return resolve_user(scope['session'])
+
+
+class CachedAuthMiddleware(AuthMiddleware):
+    """
+    AuthMiddleware that resolves session -> user -> profile through the cache
+    """
+
+    async def resolve_scope(self, scope):
+        scope['user']._wrapped = await get_cached_user(scope)
+
+
+def CachedAuthMiddlewareStack(inner):
+    return CookieMiddleware(SessionMiddleware(CachedAuthMiddleware(inner)))
@@ -1,18 +1,60 @@
+import asyncio
 import json
+import logging
+from asgiref.sync import sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.utils import timezone
+from .fanout import group_send_all, member_group_name, room_group_names
+from .fragments import bump_room_version, bump_user_version
 from .models import ChatRoom, Message, UserProfile
+from .notifications import (
+    claim_room_digests,
+    claim_user_digests,
+    digest_window,
+    mark_connected,
+    mark_disconnected,
+    notification_presence_key,
+    presence_refresh_interval,
+    record_missed_message,
+    refresh_presence,
+    room_presence_key,
+)
+from .profiling import profiled
+from .ratelimit import ConnectionRateLimiter
+
+
+logger = logging.getLogger(__name__)
+
+
+async def keep_presence_alive(key):
+    """
+    Renew a socket's presence counter until the task is cancelled
+    """
+    while True:
+        await asyncio.sleep(presence_refresh_interval())
+        await sync_to_async(refresh_presence, thread_sensitive=False)(key)
 
 
 class ChatConsumer(AsyncWebsocketConsumer):
+    @profiled('ChatConsumer.connect')
     async def connect(self):
         self.room_id = self.scope['url_route']['kwargs']['room_id']
-        self.room_group_name = f'chat_{self.room_id}'
         self.user = self.scope['user']
         
         if self.user.is_authenticated:
+            self.rate_limiter = ConnectionRateLimiter(self.user.id)
+            
+            # Large rooms spread their members over several shard groups
+            self.fanout_mode = await self.get_fanout_mode()
+            self.room_group_name = member_group_name(
+                self.room_id, self.fanout_mode, self.channel_name
+            )
+            self.room_group_names = room_group_names(self.room_id, self.fanout_mode)
+            self.can_post = self.fanout_mode != 'broadcast' or await self.get_can_post()
+            
             # Join room group
             await self.channel_layer.group_add(
                 self.room_group_name,
@@ -23,17 +65,23 @@ class ChatConsumer(AsyncWebsocketConsumer):
             
             # Update user online status
             await self.update_user_status(True)
+            await self.update_room_presence(True)
+            self.presence_task = asyncio.ensure_future(
+                keep_presence_alive(room_presence_key(self.room_id, self.user.id))
+            )
             
             # Notify others in the room
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_status',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'online': True,
-                }
-            )
+            if self.fanout_mode != 'broadcast':
+                await group_send_all(
+                    self.channel_layer,
+                    self.room_group_names,
+                    {
+                        'type': 'user_status',
+                        'user_id': self.user.id,
+                        'username': self.user.username,
+                        'online': True,
+                    }
+                )
     
     async def disconnect(self, close_code):
         if hasattr(self, 'room_group_name'):
@@ -44,32 +92,57 @@ class ChatConsumer(AsyncWebsocketConsumer):
             )
             
             # Update user online status
+            if hasattr(self, 'presence_task'):
+                self.presence_task.cancel()
             await self.update_user_status(False)
+            await self.update_room_presence(False)
             
             # Notify others in the room
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'user_status',
-                    'user_id': self.user.id,
-                    'username': self.user.username,
-                    'online': False,
-                }
-            )
+            if self.fanout_mode != 'broadcast':
+                await group_send_all(
+                    self.channel_layer,
+                    self.room_group_names,
+                    {
+                        'type': 'user_status',
+                        'user_id': self.user.id,
+                        'username': self.user.username,
+                        'online': False,
+                    }
+                )
     
+    @profiled('ChatConsumer.receive')
     async def receive(self, text_data):
         data = json.loads(text_data)
         message_type = data.get('type')
         
+        retry_after = await self.rate_limiter.check(message_type)
+        if retry_after is not None:
+            await self.send(text_data=json.dumps({
+                'type': 'error',
+                'code': 'rate_limited',
+                'frame_type': message_type,
+                'retry_after': round(retry_after, 2),
+            }))
+            return
+        
         if message_type == 'chat_message':
+            if not self.can_post:
+                await self.send(text_data=json.dumps({
+                    'type': 'error',
+                    'code': 'read_only',
+                    'frame_type': message_type,
+                }))
+                return
+            
             content = data['message']
             
             # Save message to database
             message = await self.save_message(content)
             
             # Send message to room group
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            await group_send_all(
+                self.channel_layer,
+                self.room_group_names,
                 {
                     'type': 'chat_message',
                     'message_id': message.id,
@@ -79,10 +152,20 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'timestamp': message.created.isoformat(),
                 }
             )
+            
+            # Participants away from the room get one digest per window
+            opened = await self.record_missed_message(message)
+            if opened:
+                asyncio.ensure_future(self.deliver_digests(opened))
         
         elif message_type == 'typing':
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            # Broadcast rooms are too large for typing indicators
+            if self.fanout_mode == 'broadcast':
+                return
+            
+            await group_send_all(
+                self.channel_layer,
+                self.room_group_names,
                 {
                     'type': 'typing_indicator',
                     'user_id': self.user.id,
@@ -95,8 +178,13 @@ class ChatConsumer(AsyncWebsocketConsumer):
             message_id = data['message_id']
             await self.mark_message_as_read(message_id)
             
-            await self.channel_layer.group_send(
-                self.room_group_name,
+            # Nobody follows who read what among thousands of members
+            if self.fanout_mode == 'broadcast':
+                return
+            
+            await group_send_all(
+                self.channel_layer,
+                self.room_group_names,
                 {
                     'type': 'read_receipt',
                     'message_id': message_id,
@@ -140,6 +228,29 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'username': event['username'],
         }))
     
+    async def deliver_digests(self, user_ids):
+        """
+        Push the digests opened by a message once their window has passed
+        """
+        try:
+            await asyncio.sleep(digest_window())
+            for user_id, event in await self.claim_room_digests(user_ids):
+                await self.channel_layer.group_send(f'user_{user_id}_notifications', event)
+        except Exception:
+            logger.exception('Failed to deliver notification digests for room %s', self.room_id)
+    
+    @database_sync_to_async
+    def get_fanout_mode(self):
+        fanout_mode = ChatRoom.objects.filter(id=self.room_id).values_list(
+            'fanout_mode', flat=True
+        ).first()
+        return fanout_mode or 'flat'
+    
+    @database_sync_to_async
+    def get_can_post(self):
+        room = ChatRoom.objects.filter(id=self.room_id).first()
+        return room is not None and room.can_post(self.user)
+    
     @database_sync_to_async
     def save_message(self, content):
         room = ChatRoom.objects.get(id=self.room_id)
@@ -152,21 +263,48 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     @database_sync_to_async
     def update_user_status(self, online):
-        profile, created = UserProfile.objects.get_or_create(user=self.user)
-        profile.online = online
-        profile.last_seen = timezone.now()
-        profile.save()
+        # A single UPDATE; the profile itself comes with the cached user
+        profiles = UserProfile.objects.filter(user=self.user)
+        if not profiles.update(online=online, last_seen=timezone.now()):
+            try:
+                with transaction.atomic():
+                    UserProfile.objects.create(user=self.user, online=online)
+            except IntegrityError:
+                # Another socket of the user created it first
+                profiles.update(online=online, last_seen=timezone.now())
+        bump_user_version(self.user.id)
+    
+    @database_sync_to_async
+    def update_room_presence(self, connected):
+        key = room_presence_key(self.room_id, self.user.id)
+        if connected:
+            mark_connected(key)
+        else:
+            mark_disconnected(key)
+    
+    @database_sync_to_async
+    def record_missed_message(self, message):
+        recipient_ids = ChatRoom.participants.through.objects.filter(
+            chatroom_id=self.room_id
+        ).exclude(user_id=self.user.id).values_list('user_id', flat=True)
+        return record_missed_message(message, list(recipient_ids))
+    
+    @database_sync_to_async
+    def claim_room_digests(self, user_ids):
+        return claim_room_digests(self.room_id, user_ids)
     
     @database_sync_to_async
     def mark_message_as_read(self, message_id):
         try:
             message = Message.objects.get(id=message_id)
             message.mark_as_read()
+            bump_room_version(message.room_id)
         except Message.DoesNotExist:
             pass
 
 
 class NotificationConsumer(AsyncWebsocketConsumer):
+    @profiled('NotificationConsumer.connect')
     async def connect(self):
         self.user = self.scope['user']
         
@@ -179,6 +317,14 @@ class NotificationConsumer(AsyncWebsocketConsumer):
             )
             
             await self.accept()
+            
+            # Deliver digests that piled up while the user was away
+            await self.update_presence(True)
+            self.presence_task = asyncio.ensure_future(
+                keep_presence_alive(notification_presence_key(self.user.id))
+            )
+            for _, event in await self.claim_digests():
+                await self.send_notification(event)
     
     async def disconnect(self, close_code):
         if hasattr(self, 'notification_group_name'):
@@ -186,6 +332,20 @@ class NotificationConsumer(AsyncWebsocketConsumer):
                 self.notification_group_name,
                 self.channel_name
             )
+            self.presence_task.cancel()
+            await self.update_presence(False)
     
     async def send_notification(self, event):
-        await self.send(text_data=json.dumps(event))
\ No newline at end of file
+        await self.send(text_data=json.dumps(event))
+    
+    @database_sync_to_async
+    def update_presence(self, connected):
+        key = notification_presence_key(self.user.id)
+        if connected:
+            mark_connected(key)
+        else:
+            mark_disconnected(key)
+    
+    @database_sync_to_async
+    def claim_digests(self):
+        return claim_user_digests(self.user.id)
\ No newline at end of file
@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Max, Q
+
+from .models import ChatRoom, Contact, UserProfile
+
+
+def contacts_cache_key(user_id):
+    return f'chat:contacts:{user_id}'
+
+
+def serialize_user(user):
+    """
+    Plain-dict view of a user that is safe to cache and return as JSON
+    """
+    try:
+        profile = user.profile
+    except UserProfile.DoesNotExist:
+        profile = None
+
+    return {
+        'id': user.id,
+        'username': user.username,
+        'full_name': user.get_full_name() or user.username,
+        'profile_picture': profile.profile_picture.url if profile and profile.profile_picture else '',
+        'online': bool(profile and profile.is_online),
+    }
+
+
+def serialize_contact(contact):
+    data = serialize_user(contact.user)
+    data.update({
+        'room_id': contact.room_id,
+        'message_count': contact.message_count,
+        'last_interaction': contact.last_interaction.isoformat(),
+    })
+    return data
+
+
+def build_contact_directory(user, limit=None):
+    """
+    Recent and frequent contacts of a user, read from the precomputed
+    Contact rows
+    """
+    limit = limit or settings.CHAT_SETTINGS.get('CONTACTS_TOP_N', 5)
+    contacts = Contact.objects.filter(owner=user).select_related('user__profile')
+
+    recent = contacts.order_by('-last_interaction')[:limit]
+    frequent = contacts.order_by('-message_count', '-last_interaction')[:limit]
+
+    return {
+        'recent': [serialize_contact(contact) for contact in recent],
+        'frequent': [serialize_contact(contact) for contact in frequent],
+        'count': Contact.objects.filter(owner=user).count(),
+    }
+
+
+def get_contact_directory(user):
+    """
+    Cached contact directory for the dashboard and the contacts endpoint
+    """
+    cache_key = contacts_cache_key(user.id)
+    directory = cache.get(cache_key)
+    if directory is None:
+        directory = build_contact_directory(user)
+        cache.set(cache_key, directory, settings.CHAT_SETTINGS.get('CONTACTS_CACHE_TIMEOUT', 60))
+    return directory
+
+
+def invalidate_contacts(user_ids):
+    cache.delete_many([contacts_cache_key(user_id) for user_id in user_ids])
+
+
+def record_direct_chat(room, user, other_user):
+    """
+    Create the contact rows for both sides of a direct chat
+    """
+    Contact.objects.bulk_create(
+        [
+            Contact(owner=user, user=other_user, room=room),
+            Contact(owner=other_user, user=user, room=room),
+        ],
+        ignore_conflicts=True,
+    )
+    invalidate_contacts([user.id, other_user.id])
+
+
+def record_message(message):
+    """
+    Bump the contact counters of a direct room after a new message
+    """
+    if message.room.room_type != 'direct':
+        return
+
+    contacts = Contact.objects.filter(room_id=message.room_id)
+    contacts.update(
+        message_count=F('message_count') + 1,
+        last_interaction=message.created,
+    )
+    invalidate_contacts(contacts.values_list('owner_id', flat=True))
+
+
+def search_users(user, query, cursor=None, limit=20):
+    """
+    Prefix search over lowercased usernames with keyset pagination.
+    Returns the page of users and the cursor of the next page, if any.
+    """
+    profiles = UserProfile.objects.filter(
+        search_name__startswith=query.strip().lower()
+    ).exclude(user=user).select_related('user').order_by('search_name', 'user_id')
+
+    if cursor:
+        search_name, _, user_id = cursor.rpartition(':')
+        if user_id.isdigit():
+            profiles = profiles.filter(
+                Q(search_name__gt=search_name) | Q(search_name=search_name, user_id__gt=int(user_id))
+            )
+
+    page = list(profiles[:limit + 1])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = f'{page[-1].search_name}:{page[-1].user_id}'
+
+    return [serialize_user(profile.user) for profile in page], next_cursor
+
+
+def rebuild_contacts(batch_size=500):
+    """
+    Recompute every Contact row from the existing direct rooms
+    """
+    rooms = ChatRoom.objects.filter(room_type='direct').annotate(
+        message_count=Count('messages'),
+        last_message_time=Max('messages__created'),
+    ).prefetch_related('participants').order_by('id')
+
+    total = 0
+    batch = []
+    for room in rooms.iterator(chunk_size=batch_size):
+        participants = list(room.participants.all())
+        if len(participants) != 2:
+            continue
+        for owner, other in (participants, reversed(participants)):
+            batch.append(Contact(
+                owner=owner,
+                user=other,
+                room=room,
+                message_count=room.message_count,
+                last_interaction=room.last_message_time or room.created,
+            ))
+        if len(batch) >= batch_size:
+            total += _save_contacts(batch)
+            batch = []
+
+    if batch:
+        total += _save_contacts(batch)
+    return total
+
+
+def _save_contacts(contacts):
+    Contact.objects.bulk_create(
+        contacts,
+        update_conflicts=True,
+        unique_fields=['owner', 'user'],
+        update_fields=['room', 'message_count', 'last_interaction'],
+    )
+    invalidate_contacts({contact.owner_id for contact in contacts})
+    return len(contacts)
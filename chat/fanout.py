@@ -0,0 +1,54 @@
+import asyncio
+import zlib
+
+from django.conf import settings
+
+
+def get_shard_count():
+    """
+    Number of shard groups a large room's membership is split into
+    """
+    return max(1, settings.CHAT_SETTINGS.get('FANOUT_SHARDS', 8))
+
+
+def is_large_room(participant_count):
+    """
+    Whether a room of this size should use sharded fan-out
+    """
+    threshold = settings.CHAT_SETTINGS.get('LARGE_ROOM_THRESHOLD')
+    return threshold is not None and participant_count >= threshold
+
+
+def room_group_names(room_id, fanout_mode, shards=None):
+    """
+    All channel layer groups a room message has to be sent to
+    """
+    if fanout_mode == 'flat':
+        return [f'chat_{room_id}']
+    shards = shards or get_shard_count()
+    return [f'chat_{room_id}_s{shard}' for shard in range(shards)]
+
+
+def member_group_name(room_id, fanout_mode, channel_name, shards=None):
+    """
+    The single group a connection joins; sharded rooms pick it from the
+    channel name so members spread evenly across the shard groups
+    """
+    if fanout_mode == 'flat':
+        return f'chat_{room_id}'
+    shards = shards or get_shard_count()
+    shard = zlib.crc32(channel_name.encode()) % shards
+    return f'chat_{room_id}_s{shard}'
+
+
+async def group_send_all(channel_layer, group_names, message):
+    """
+    Send one event to every group of a room concurrently
+    """
+    if len(group_names) == 1:
+        await channel_layer.group_send(group_names[0], message)
+        return
+    await asyncio.gather(*(
+        channel_layer.group_send(group_name, message)
+        for group_name in group_names
+    ))
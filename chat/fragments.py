@@ -0,0 +1,61 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def room_version_key(room_id):
+    return f'chat:room:{room_id}:version'
+
+
+def user_version_key(user_id):
+    return f'chat:user:{user_id}:version'
+
+
+def fragment_cache_timeout():
+    return settings.CHAT_SETTINGS.get('FRAGMENT_CACHE_TIMEOUT', 60)
+
+
+def _initial_version():
+    # Seeded from the clock so a counter lost from the cache never restarts
+    # at a value that still names old fragments
+    return int(time.time() * 1000)
+
+
+def get_versions(keys):
+    """
+    Current value of several version counters in one cache round trip
+    """
+    versions = cache.get_many(keys)
+    missing = {key: _initial_version() for key in keys if key not in versions}
+    for key, version in missing.items():
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+        versions[key] = version
+    return versions
+
+
+def get_room_version(room_id):
+    key = room_version_key(room_id)
+    return get_versions([key])[key]
+
+
+def _bump(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, _initial_version(), None)
+
+
+def bump_room_version(room_id):
+    """
+    Invalidate every cached fragment that renders this room
+    """
+    _bump(room_version_key(room_id))
+
+
+def bump_user_version(user_id):
+    """
+    Invalidate every cached fragment that renders this user
+    """
+    _bump(user_version_key(user_id))
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import uuid
+
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+from django.utils.module_loading import import_string
+
+from .workers import current_worker, group_room_id, room_worker
+
+
+logger = logging.getLogger(__name__)
+
+RELAY_TYPE = 'affinity.relay'
+
+
+class AffinityChannelLayer(BaseChannelLayer):
+    """
+    In-process channel layer for workers started by runworkers, with an
+    optional cross-worker ("remote") layer used only when needed.
+
+    Sockets of a room are routed to the worker that owns the room, so a
+    group_send to one of its chat groups is delivered locally and never
+    touches the remote layer. Any other group_send is delivered locally
+    and relayed through the remote layer to the other processes that have
+    members in the group.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, remote=None, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.local = InMemoryChannelLayer(
+            expiry=expiry,
+            group_expiry=group_expiry,
+            capacity=capacity,
+            channel_capacity=channel_capacity,
+        )
+        self.remote_config = remote
+        self.remote = None
+        self.remote_channel = None
+        self.relay_task = None
+        self.remote_lock = asyncio.Lock()
+        self.remote_groups = {}
+        self.origin = uuid.uuid4().hex
+        self.worker_id, self.worker_count = current_worker()
+
+    def owns_group(self, group):
+        """
+        Whether every member of this group is connected to this worker
+        """
+        if self.worker_count is None:
+            return False
+        room_id = group_room_id(group)
+        return room_id is not None and room_worker(room_id, self.worker_count) == self.worker_id
+
+    async def get_remote(self):
+        if self.remote_config is None:
+            return None
+        async with self.remote_lock:
+            if self.remote is None:
+                backend = import_string(self.remote_config['BACKEND'])
+                self.remote = backend(**self.remote_config.get('CONFIG', {}))
+                self.remote_channel = await self.remote.new_channel()
+                self.relay_task = asyncio.ensure_future(self.relay())
+        return self.remote
+
+    async def relay(self):
+        """
+        Deliver group messages relayed by other processes to local members
+        """
+        while True:
+            try:
+                envelope = await self.remote.receive(self.remote_channel)
+                if envelope.get('origin') == self.origin:
+                    continue
+                await self.local.group_send(envelope['group'], envelope['message'])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Failed to relay a cross-worker group message')
+
+    # Channels
+
+    async def new_channel(self, prefix='specific.'):
+        return await self.local.new_channel(prefix)
+
+    def is_local_channel(self, channel):
+        return '.inmemory!' in channel
+
+    async def send(self, channel, message):
+        if self.is_local_channel(channel):
+            return await self.local.send(channel, message)
+        remote = await self.get_remote()
+        if remote is None:
+            return await self.local.send(channel, message)
+        await remote.send(channel, message)
+
+    async def receive(self, channel):
+        return await self.local.receive(channel)
+
+    # Groups
+
+    async def group_add(self, group, channel):
+        await self.local.group_add(group, channel)
+        if self.owns_group(group):
+            # Only this worker's sockets join or send to the room's groups
+            return
+        remote = await self.get_remote()
+        if remote is None:
+            return
+        members = self.remote_groups.setdefault(group, set())
+        if not members:
+            await remote.group_add(group, self.remote_channel)
+        members.add(channel)
+
+    async def group_discard(self, group, channel):
+        await self.local.group_discard(group, channel)
+        members = self.remote_groups.get(group)
+        if members is None:
+            return
+        members.discard(channel)
+        if not members:
+            del self.remote_groups[group]
+            await self.remote.group_discard(group, self.remote_channel)
+
+    async def group_send(self, group, message):
+        await self.local.group_send(group, message)
+        if self.owns_group(group):
+            return
+        remote = await self.get_remote()
+        if remote is None:
+            return
+        await remote.group_send(group, {
+            'type': RELAY_TYPE,
+            'origin': self.origin,
+            'group': group,
+            'message': message,
+        })
+
+    # Flush extension
+
+    async def flush(self):
+        await self.local.flush()
+        if self.remote is not None:
+            await self.remote.flush()
+        self.remote_groups = {}
+
+    async def close(self):
+        if self.relay_task is not None:
+            self.relay_task.cancel()
+        await self.local.close()
+        if self.remote is not None and hasattr(self.remote, 'close_pools'):
+            await self.remote.close_pools()
@@ -0,0 +1,65 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.core.management.base import BaseCommand
+
+from chat.fanout import group_send_all, member_group_name, room_group_names
+
+
+class Command(BaseCommand):
+    help = 'Compare flat and sharded group fan-out for a large room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=100)
+        parser.add_argument('--shards', type=int, default=8)
+        parser.add_argument(
+            '--in-memory',
+            action='store_true',
+            help='Use an InMemoryChannelLayer instead of the configured default layer',
+        )
+
+    def handle(self, *args, **options):
+        for fanout_mode in ('flat', 'sharded'):
+            elapsed = asyncio.run(self.run_mode(fanout_mode, options))
+            deliveries = options['members'] * options['messages']
+            self.stdout.write(
+                f"{fanout_mode:>8}: {options['messages']} messages to "
+                f"{options['members']} members in {elapsed:.3f}s "
+                f"({options['messages'] / elapsed:.1f} msg/s, "
+                f"{deliveries / elapsed:.0f} deliveries/s)"
+            )
+
+    async def run_mode(self, fanout_mode, options):
+        if options['in_memory']:
+            channel_layer = InMemoryChannelLayer(capacity=options['messages'] + 1)
+        else:
+            channel_layer = get_channel_layer()
+        room_id = f'bench{fanout_mode}'
+        shards = options['shards']
+
+        channels = []
+        for _ in range(options['members']):
+            channel_name = await channel_layer.new_channel()
+            group_name = member_group_name(room_id, fanout_mode, channel_name, shards)
+            await channel_layer.group_add(group_name, channel_name)
+            channels.append((group_name, channel_name))
+
+        group_names = room_group_names(room_id, fanout_mode, shards)
+        event = {'type': 'chat_message', 'content': 'x' * 100}
+
+        async def drain(channel_name):
+            for _ in range(options['messages']):
+                await channel_layer.receive(channel_name)
+
+        started = time.perf_counter()
+        receivers = asyncio.gather(*(drain(channel_name) for _, channel_name in channels))
+        for _ in range(options['messages']):
+            await group_send_all(channel_layer, group_names, event)
+        await receivers
+        elapsed = time.perf_counter() - started
+
+        for group_name, channel_name in channels:
+            await channel_layer.group_discard(group_name, channel_name)
+        return elapsed
@@ -0,0 +1,323 @@
+import asyncio
+import base64
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import import_module
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.models import ChatRoom, UserProfile
+from chat.notifications import digest_window
+from chat.ratelimit import get_frame_limits
+
+
+HOST = '127.0.0.1'
+
+
+class BenchSocket:
+    """
+    Minimal WebSocket client, text frames only: enough to drive the chat
+    consumers through runworkers without a client library
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port, path, session_key):
+        reader, writer = await asyncio.open_connection(HOST, port)
+        writer.write((
+            f'GET {path} HTTP/1.1\r\n'
+            f'Host: {HOST}:{port}\r\n'
+            f'Origin: http://{HOST}:{port}\r\n'
+            f'Upgrade: websocket\r\n'
+            f'Connection: Upgrade\r\n'
+            f'Sec-WebSocket-Key: {base64.b64encode(os.urandom(16)).decode()}\r\n'
+            f'Sec-WebSocket-Version: 13\r\n'
+            f'Cookie: {settings.SESSION_COOKIE_NAME}={session_key}\r\n\r\n'
+        ).encode('latin-1'))
+        status = (await reader.readuntil(b'\r\n\r\n')).split(b'\r\n', 1)[0].decode('latin-1')
+        if ' 101 ' not in status:
+            writer.close()
+            raise ConnectionError(f'{path} rejected: {status}')
+        return cls(reader, writer)
+
+    def send_frame(self, opcode, payload):
+        # Client frames are masked
+        mask = os.urandom(4)
+        length = len(payload)
+        if length < 126:
+            header = bytes([0x80 | opcode, 0x80 | length])
+        elif length < 65536:
+            header = bytes([0x80 | opcode, 0x80 | 126]) + length.to_bytes(2, 'big')
+        else:
+            header = bytes([0x80 | opcode, 0x80 | 127]) + length.to_bytes(8, 'big')
+        masked = int.from_bytes(payload, 'big') ^ int.from_bytes((mask * (length // 4 + 1))[:length], 'big')
+        self.writer.write(header + mask + masked.to_bytes(length, 'big'))
+
+    async def send_json(self, data):
+        self.send_frame(0x1, json.dumps(data).encode())
+        await self.writer.drain()
+
+    async def receive_json(self):
+        while True:
+            first, second = await self.reader.readexactly(2)
+            length = second & 0x7f
+            if length == 126:
+                length = int.from_bytes(await self.reader.readexactly(2), 'big')
+            elif length == 127:
+                length = int.from_bytes(await self.reader.readexactly(8), 'big')
+            payload = await self.reader.readexactly(length)
+            opcode = first & 0x0f
+            if opcode == 0x1:
+                return json.loads(payload)
+            if opcode == 0x8:
+                raise ConnectionError('closed by the server')
+            if opcode == 0x9:
+                self.send_frame(0xa, payload)
+
+    async def close(self):
+        try:
+            self.send_frame(0x8, b'')
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure WebSocket message throughput and latency through runworkers, '
+        'with room traffic kept inside a worker and notification digests '
+        'crossing workers'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--rooms', type=int, default=8)
+        parser.add_argument('--members', type=int, default=10, help='Connected room sockets per room')
+        parser.add_argument(
+            '--absent',
+            type=int,
+            default=2,
+            help='Participants per room holding only a notification socket; their digests cross workers',
+        )
+        parser.add_argument('--messages', type=int, default=10, help='Messages each member sends')
+        parser.add_argument('--interval', type=float, help='Seconds between the messages of a member')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--timeout', type=float, default=60)
+
+    def handle(self, *args, **options):
+        if not settings.REDIS_URL and (max(options['workers']) > 1 or options['absent']):
+            # Workers share the cache and relay notifications through Redis
+            raise CommandError('Set REDIS_URL, or run a single worker with --absent 0')
+        if options['interval'] is None:
+            options['interval'] = self.paced_interval()
+
+        self.session_store = import_module(settings.SESSION_ENGINE).SessionStore
+        rooms = self.create_rooms(options)
+        try:
+            baseline = None
+            for worker_count in options['workers']:
+                result = self.run_workers(worker_count, rooms, options)
+                baseline = baseline or result['throughput'] or None
+                self.stdout.write(
+                    f"{worker_count:>3} workers: {result['delivered']}/{result['expected']} room deliveries "
+                    f"in {result['elapsed']:.2f}s ({result['throughput']:.0f}/s, "
+                    f"{result['throughput'] / (baseline or 1):.2f}x), "
+                    f"latency p50 {result['p50'] * 1000:.1f}ms p99 {result['p99'] * 1000:.1f}ms"
+                )
+                if options['absent']:
+                    self.stdout.write(
+                        f"             {result['digested']}/{result['expected_digested']} messages in "
+                        f"{result['digests']} cross-worker digests, latency p50 "
+                        f"{result['digest_p50']:.2f}s (window {digest_window()}s)"
+                    )
+                if result['limited']:
+                    self.stdout.write(f"             {result['limited']} messages rate limited, raise --interval")
+        finally:
+            self.delete_rooms(rooms)
+
+    def paced_interval(self):
+        """
+        Fastest pace the chat_message rate limits allow one socket of a user
+        """
+        limits = get_frame_limits('chat_message') or {}
+        rates = [limit['rate'] for limit in limits.values()]
+        return 1 / min(rates) if rates else 0
+
+    # Fixtures
+
+    def create_rooms(self, options):
+        """
+        Bench rooms with their users logged in: {'id', 'members', 'absent'}
+        where members and absent are session keys
+        """
+        prefix = f'bench-{os.getpid()}'
+        rooms = []
+        for room_index in range(options['rooms']):
+            room = ChatRoom.objects.create(name=f'{prefix}-{room_index}', room_type='group')
+            users = [
+                User(username=f'{prefix}-{room_index}-{index}')
+                for index in range(options['members'] + options['absent'])
+            ]
+            for user in users:
+                user.set_unusable_password()
+            users = User.objects.bulk_create(users)
+            UserProfile.objects.bulk_create([
+                UserProfile(user=user, search_name=user.username) for user in users
+            ])
+            room.participants.add(*users)
+            sessions = [self.log_in(user) for user in users]
+            rooms.append({
+                'id': room.id,
+                'members': sessions[:options['members']],
+                'absent': sessions[options['members']:],
+            })
+        return rooms
+
+    def log_in(self, user):
+        session = self.session_store()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return session.session_key
+
+    def delete_rooms(self, rooms):
+        for room in rooms:
+            for session_key in room['members'] + room['absent']:
+                self.session_store(session_key).delete()
+        room_ids = [room['id'] for room in rooms]
+        User.objects.filter(chat_rooms__id__in=room_ids).delete()
+        ChatRoom.objects.filter(id__in=room_ids).delete()
+
+    # Workers
+
+    def run_workers(self, worker_count, rooms, options):
+        with tempfile.TemporaryDirectory(prefix='bench-workers-') as socket_dir:
+            process = subprocess.Popen(
+                [
+                    sys.executable, str(Path(settings.BASE_DIR) / 'manage.py'), 'runworkers',
+                    '--workers', str(worker_count),
+                    '--bind', HOST,
+                    '--port', str(options['port']),
+                    '--socket-dir', socket_dir,
+                ],
+                stdout=subprocess.DEVNULL,
+            )
+            try:
+                self.wait_for_workers(process, socket_dir, worker_count)
+                return asyncio.run(self.run_clients(rooms, options))
+            finally:
+                process.send_signal(signal.SIGTERM)
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+
+    def wait_for_workers(self, process, socket_dir, worker_count, timeout=30):
+        deadline = time.monotonic() + timeout
+        sockets = [Path(socket_dir) / f'worker-{worker_id}.sock' for worker_id in range(worker_count)]
+        while not all(path.exists() for path in sockets):
+            if process.poll() is not None:
+                raise CommandError(f'runworkers exited with {process.returncode}')
+            if time.monotonic() > deadline:
+                raise CommandError(f'{worker_count} workers did not start within {timeout}s')
+            time.sleep(0.1)
+
+    # Clients
+
+    async def run_clients(self, rooms, options):
+        port = options['port']
+        messages = options['messages']
+        stats = {'latencies': [], 'digest_latencies': [], 'digested': 0, 'limited': 0}
+
+        # Sockets of a room all land on the worker owning it; notification
+        # sockets are spread round-robin, so most digests cross workers
+        members = [
+            await BenchSocket.connect(port, f"/ws/chat/{room['id']}/", session_key)
+            for room in rooms for session_key in room['members']
+        ]
+        notified = [
+            await BenchSocket.connect(port, '/ws/notifications/', session_key)
+            for room in rooms for session_key in room['absent']
+        ]
+
+        async def read_room(socket):
+            received = 0
+            while received < options['members'] * messages:
+                frame = await socket.receive_json()
+                if frame['type'] == 'chat_message':
+                    stats['latencies'].append(time.perf_counter() - float(frame['content'].split()[1]))
+                    received += 1
+                elif frame['type'] == 'error':
+                    stats['limited'] += 1
+
+        async def read_notifications(socket):
+            missed = 0
+            while missed < options['members'] * messages:
+                frame = await socket.receive_json()
+                if frame.get('notification_type') == 'message_digest':
+                    stats['digest_latencies'].append(
+                        time.perf_counter() - float(frame['latest_preview'].split()[1])
+                    )
+                    stats['digested'] += frame['count']
+                    missed += frame['count']
+
+        async def send(socket):
+            for _ in range(messages):
+                await socket.send_json({'type': 'chat_message', 'message': f'bench {time.perf_counter()!r}'})
+                await asyncio.sleep(options['interval'])
+
+        started = time.perf_counter()
+        rooms_done = asyncio.gather(*(read_room(socket) for socket in members))
+        digests_done = asyncio.gather(*(read_notifications(socket) for socket in notified))
+        try:
+            await asyncio.gather(*(send(socket) for socket in members))
+            await asyncio.wait_for(asyncio.shield(rooms_done), options['timeout'])
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError) as error:
+            self.stderr.write(f'Room traffic incomplete: {error!r}')
+        elapsed = time.perf_counter() - started
+        try:
+            # The last digests go out one window after the last message
+            await asyncio.wait_for(asyncio.shield(digests_done), digest_window() + options['timeout'])
+        except (asyncio.TimeoutError, ConnectionError, asyncio.IncompleteReadError) as error:
+            self.stderr.write(f'Digests incomplete: {error!r}')
+        rooms_done.cancel()
+        digests_done.cancel()
+
+        for socket in members + notified:
+            await socket.close()
+
+        latencies = stats['latencies']
+        return {
+            'expected': len(members) * options['members'] * messages,
+            'delivered': len(latencies),
+            'elapsed': elapsed,
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'expected_digested': len(notified) * options['members'] * messages,
+            'digested': stats['digested'],
+            'digests': len(stats['digest_latencies']),
+            'digest_p50': percentile(stats['digest_latencies'], 0.5),
+            'limited': stats['limited'],
+        }
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from chat.profiling import summarize
+
+
+class Command(BaseCommand):
+    help = 'Summarize the recorded profiles and slow queries per handler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--handler', help='Only this view name or consumer handler')
+        parser.add_argument('--limit', type=int, default=25)
+        parser.add_argument('--sort', default='cumulative', help='pstats sort key, e.g. tottime or ncalls')
+
+    def handle(self, *args, **options):
+        self.stdout.write(summarize(
+            handler=options['handler'],
+            limit=options['limit'],
+            sort=options['sort'],
+        ))
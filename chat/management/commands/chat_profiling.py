@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.profiling import get_config, reset_config, set_config
+from chat.workers import process_local_cache
+
+
+class Command(BaseCommand):
+    help = 'Switch request and frame profiling on or off at runtime'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sample-rate', type=float, help='Fraction of requests and frames to profile')
+        parser.add_argument('--slow-query-ms', type=float, help='Log queries slower than this')
+        parser.add_argument('--off', action='store_true', help='Stop profiling and slow query logging')
+        parser.add_argument('--reset', action='store_true', help='Go back to the CHAT_SETTINGS defaults')
+
+    def handle(self, *args, **options):
+        if options['sample_rate'] is not None and not 0 <= options['sample_rate'] <= 1:
+            raise CommandError('--sample-rate must be between 0 and 1')
+        changes = options['reset'] or options['off'] or any(
+            options[key] is not None for key in ('sample_rate', 'slow_query_ms')
+        )
+        backend = process_local_cache()
+        if changes and backend:
+            # The switch would only reach this command's own process
+            raise CommandError(
+                f'{backend} is per process; set REDIS_URL or configure a shared cache, '
+                f'or change CHAT_SETTINGS["PROFILING"] and restart'
+            )
+
+        if options['reset']:
+            reset_config()
+        elif options['off']:
+            set_config(sample_rate=0, slow_query_ms=None)
+        else:
+            config = {
+                key: options[key] for key in ('sample_rate', 'slow_query_ms')
+                if options[key] is not None
+            }
+            if config:
+                set_config(**config)
+
+        config = get_config()
+        slow_query = f"{config['slow_query_ms']}ms" if config['slow_query_ms'] is not None else 'off'
+        self.stdout.write(
+            f"Sampling {config['sample_rate'] * 100:g}% of requests and frames, "
+            f"slow query log: {slow_query}"
+        )
+        self.stdout.write('Running processes pick up changes within a few seconds')
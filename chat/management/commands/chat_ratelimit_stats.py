@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.ratelimit import read_stats, reset_stats
+from chat.workers import process_local_cache
+
+
+class Command(BaseCommand):
+    help = 'Show allowed and rate-limited WebSocket frame counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the counters after printing')
+
+    def handle(self, *args, **options):
+        backend = process_local_cache()
+        if backend:
+            # The counters live in the servers' caches, this process has its own
+            raise CommandError(f'{backend} is per process; set REDIS_URL or configure a shared cache')
+        for frame_type, counts in read_stats().items():
+            total = counts['allowed'] + counts['limited']
+            share = counts['limited'] / total * 100 if total else 0
+            self.stdout.write(
+                f"{frame_type:>14}: {counts['allowed']} allowed, "
+                f"{counts['limited']} limited ({share:.1f}%)"
+            )
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
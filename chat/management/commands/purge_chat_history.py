@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.retention import Purger
+from chat.workers import process_local_cache
+
+
+class Command(BaseCommand):
+    help = 'Delete messages and inactive rooms past their retention policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0.1, help='Seconds to pause between batches')
+        parser.add_argument('--dry-run', action='store_true', help='Count what would be deleted')
+        parser.add_argument('--resume', action='store_true', help='Continue after the last purged room')
+
+    def handle(self, *args, **options):
+        backend = process_local_cache()
+        if options['resume'] and backend:
+            # The checkpoint of the interrupted run died with its process
+            raise CommandError(f'{backend} is per process, there is no checkpoint to resume from')
+        purger = Purger(
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            dry_run=options['dry_run'],
+            progress=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        messages, rooms = purger.run(resume=options['resume'])
+        verb = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {messages} messages and {rooms} inactive rooms'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat.contacts import rebuild_contacts
+
+
+class Command(BaseCommand):
+    help = 'Recompute the precomputed contact directory from direct rooms'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        total = rebuild_contacts(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {total} contacts'))
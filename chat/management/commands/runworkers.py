@@ -0,0 +1,179 @@
+import asyncio
+import itertools
+import os
+import signal
+import sys
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.workers import path_room_id, process_local_cache, room_worker
+
+
+MAX_HEAD_SIZE = 64 * 1024
+FORWARDED_HEADERS = (b'x-forwarded-for', b'x-forwarded-port', b'x-forwarded-proto')
+BAD_GATEWAY = (
+    b'HTTP/1.1 502 Bad Gateway\r\n'
+    b'Content-Type: text/plain\r\n'
+    b'Content-Length: 11\r\n'
+    b'Connection: close\r\n\r\n'
+    b'Bad Gateway'
+)
+
+
+def forwarded_head(head, peer):
+    """
+    Request head passed to a worker: client-supplied X-Forwarded-* headers
+    are dropped, as daphne's --proxy-headers trusts them, and replaced with
+    the address of the connected peer
+    """
+    lines = head[:-4].split(b'\r\n')
+    lines = lines[:1] + [
+        line for line in lines[1:]
+        if line.split(b':', 1)[0].strip().lower() not in FORWARDED_HEADERS
+    ]
+    if peer:
+        lines.append(f'X-Forwarded-For: {peer[0]}'.encode('latin-1'))
+        lines.append(f'X-Forwarded-Port: {peer[1]}'.encode('latin-1'))
+    return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+
+class Command(BaseCommand):
+    help = (
+        'Run several supervised daphne workers behind one port, routing the '
+        'sockets of a room to the same worker'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--bind', default='0.0.0.0')
+        parser.add_argument('--port', type=int, default=8000)
+        parser.add_argument('--socket-dir', default=None)
+        parser.add_argument('--application', default='chat_app.asgi:application')
+
+    def handle(self, *args, **options):
+        self.worker_count = max(1, options['workers'])
+        backend = process_local_cache()
+        if self.worker_count > 1 and backend:
+            # Rate limits, presence and cached users must be seen by every worker
+            raise CommandError(
+                f'{backend} is per process; set REDIS_URL or configure a shared cache '
+                f'to run {self.worker_count} workers'
+            )
+        self.application = options['application']
+        self.socket_dir = options['socket_dir'] or tempfile.mkdtemp(prefix='chat-workers-')
+        self.stopping = False
+        self.processes = {}
+        self.round_robin = itertools.cycle(range(self.worker_count))
+        asyncio.run(self.serve(options['bind'], options['port']))
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.socket_dir, f'worker-{worker_id}.sock')
+
+    # Supervision
+
+    async def supervise(self, worker_id):
+        """
+        Keep one worker process running, restarting it when it exits
+        """
+        env = dict(
+            os.environ,
+            CHAT_WORKER_ID=str(worker_id),
+            CHAT_WORKER_COUNT=str(self.worker_count),
+        )
+        backoff = 1
+        while not self.stopping:
+            socket_path = self.socket_path(worker_id)
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, '-m', 'daphne',
+                '--unix-socket', socket_path,
+                '--proxy-headers',
+                self.application,
+                env=env,
+            )
+            self.processes[worker_id] = process
+            self.stdout.write(f'Worker {worker_id} started (pid {process.pid})')
+            returncode = await process.wait()
+            if self.stopping:
+                break
+            self.stderr.write(f'Worker {worker_id} exited with {returncode}, restarting in {backoff}s')
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    async def stop(self, server):
+        self.stopping = True
+        server.close()
+        for process in self.processes.values():
+            if process.returncode is None:
+                process.terminate()
+
+    # Routing
+
+    def pick_worker(self, head):
+        """
+        Room sockets go to the worker owning the room, anything else round-robin
+        """
+        request_line = head.split(b'\r\n', 1)[0].decode('latin-1')
+        parts = request_line.split(' ')
+        room_id = path_room_id(parts[1]) if len(parts) > 1 else None
+        if room_id is not None:
+            return room_worker(room_id, self.worker_count)
+        return next(self.round_robin)
+
+    async def proxy(self, client_reader, client_writer):
+        try:
+            head = await client_reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            client_writer.close()
+            return
+
+        worker_id = self.pick_worker(head)
+        try:
+            worker_reader, worker_writer = await asyncio.open_unix_connection(self.socket_path(worker_id))
+        except OSError:
+            client_writer.write(BAD_GATEWAY)
+            await client_writer.drain()
+            client_writer.close()
+            return
+
+        # Daphne runs with --proxy-headers and takes the client address from here
+        worker_writer.write(forwarded_head(head, client_writer.get_extra_info('peername')))
+
+        await asyncio.gather(
+            self.pipe(client_reader, worker_writer),
+            self.pipe(worker_reader, client_writer),
+        )
+
+    async def pipe(self, reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, bind, port):
+        supervisors = [
+            asyncio.ensure_future(self.supervise(worker_id))
+            for worker_id in range(self.worker_count)
+        ]
+        server = await asyncio.start_server(self.proxy, bind, port, limit=MAX_HEAD_SIZE)
+        self.stdout.write(f'Routing {bind}:{port} to {self.worker_count} workers in {self.socket_dir}')
+
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, lambda: asyncio.ensure_future(self.stop(server)))
+
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+        await asyncio.gather(*supervisors)
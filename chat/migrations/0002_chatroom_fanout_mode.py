@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-19 07:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='fanout_mode',
+            field=models.CharField(choices=[('flat', 'Flat'), ('sharded', 'Sharded'), ('broadcast', 'Broadcast')], default='flat', max_length=10),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.9 on 2026-10-19 07:23
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+
+def populate_search_name(apps, schema_editor):
+    User = apps.get_model('auth', 'User')
+    UserProfile = apps.get_model('chat', 'UserProfile')
+    UserProfile.objects.update(
+        search_name=Lower(
+            models.Subquery(
+                User.objects.filter(
+                    id=models.OuterRef('user_id')
+                ).values('username')[:1]
+            )
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_chatroom_fanout_mode'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userprofile',
+            name='search_name',
+            field=models.CharField(blank=True, db_index=True, max_length=150),
+        ),
+        migrations.RunPython(populate_search_name, migrations.RunPython.noop),
+        migrations.CreateModel(
+            name='Contact',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('message_count', models.PositiveIntegerField(default=0)),
+                ('last_interaction', models.DateTimeField(default=django.utils.timezone.now)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contacts', to=settings.AUTH_USER_MODEL)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contacts', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Contact',
+                'verbose_name_plural': 'Contacts',
+                'indexes': [models.Index(fields=['owner', '-last_interaction'], name='chat_contac_owner_i_c0050d_idx'), models.Index(fields=['owner', '-message_count'], name='chat_contac_owner_i_eb4ddb_idx')],
+                'constraints': [models.UniqueConstraint(fields=('owner', 'user'), name='unique_contact')],
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.9 on 2026-10-19 07:33
+
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_contact_directory'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationDigest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False, verbose_name='created')),
+                ('modified', model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False, verbose_name='modified')),
+                ('message_count', models.PositiveIntegerField(default=1)),
+                ('latest_preview', models.CharField(blank=True, max_length=100)),
+                ('delivered_at', models.DateTimeField(blank=True, null=True)),
+                ('latest_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('latest_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notification_digests', to='chat.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notification_digests', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Notification Digest',
+                'verbose_name_plural': 'Notification Digests',
+                'indexes': [models.Index(fields=['user', 'delivered_at'], name='chat_notifi_user_id_8c866b_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('delivered_at__isnull', True)), fields=('user', 'room'), name='unique_pending_digest')],
+            },
+        ),
+    ]
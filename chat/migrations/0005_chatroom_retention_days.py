@@ -0,0 +1,18 @@
+# Generated by Django 5.2.9 on 2026-10-19 07:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_notification_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Days messages are kept; overrides the room type policy', null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.9 on 2026-10-19 08:14
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chatroom_retention_days'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='broadcasters',
+            field=models.ManyToManyField(blank=True, help_text='Who may post while the room is in broadcast mode, besides staff', related_name='broadcast_rooms', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
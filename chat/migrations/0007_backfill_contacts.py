@@ -0,0 +1,54 @@
+from django.db import migrations
+from django.db.models import Count, Max
+
+
+def backfill_contacts(apps, schema_editor):
+    """
+    Create the Contact rows of direct rooms that existed before the contact
+    directory; same result as the rebuild_contacts command
+    """
+    ChatRoom = apps.get_model('chat', 'ChatRoom')
+    Contact = apps.get_model('chat', 'Contact')
+    rooms = ChatRoom.objects.filter(room_type='direct').annotate(
+        message_count=Count('messages'),
+        last_message_time=Max('messages__created'),
+    ).prefetch_related('participants').order_by('id')
+
+    batch = []
+    for room in rooms.iterator(chunk_size=500):
+        participant_ids = [user.id for user in room.participants.all()]
+        if len(participant_ids) != 2:
+            continue
+        for owner_id, user_id in (participant_ids, reversed(participant_ids)):
+            batch.append(Contact(
+                owner_id=owner_id,
+                user_id=user_id,
+                room_id=room.id,
+                message_count=room.message_count,
+                last_interaction=room.last_message_time or room.created,
+            ))
+        if len(batch) >= 500:
+            _save_contacts(Contact, batch)
+            batch = []
+    if batch:
+        _save_contacts(Contact, batch)
+
+
+def _save_contacts(Contact, contacts):
+    Contact.objects.bulk_create(
+        contacts,
+        update_conflicts=True,
+        unique_fields=['owner', 'user'],
+        update_fields=['room', 'message_count', 'last_interaction'],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_chatroom_broadcasters'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_contacts, migrations.RunPython.noop),
+    ]
@@ -17,10 +17,28 @@ class ChatRoom(TimeStampedModel):
         ('group', _('Group Chat')),
     )
     
+    FANOUT_MODES = (
+        ('flat', _('Flat')),
+        ('sharded', _('Sharded')),
+        ('broadcast', _('Broadcast')),
+    )
+    
     name = models.CharField(max_length=255, null=True, blank=True)
     room_type = models.CharField(max_length=10, choices=ROOM_TYPES, default='direct')
     participants = models.ManyToManyField(User, related_name='chat_rooms')
     is_active = models.BooleanField(default=True)
+    fanout_mode = models.CharField(max_length=10, choices=FANOUT_MODES, default='flat')
+    broadcasters = models.ManyToManyField(
+        User,
+        related_name='broadcast_rooms',
+        blank=True,
+        help_text=_('Who may post while the room is in broadcast mode, besides staff'),
+    )
+    retention_days = models.PositiveIntegerField(
+        null=True,
+        blank=True,
+        help_text=_('Days messages are kept; overrides the room type policy'),
+    )
     
     class Meta:
         ordering = ['-modified']
@@ -34,8 +52,24 @@ class ChatRoom(TimeStampedModel):
     
     @property
     def last_message(self):
+        if hasattr(self, '_last_message'):
+            return self._last_message
         return self.messages.order_by('-created').first()
     
+    def preload_last_message(self, message):
+        """
+        Attach an already fetched last message so rendering skips the query
+        """
+        self._last_message = message
+    
+    def can_post(self, user):
+        """
+        Broadcast rooms are read-only for everyone but staff and broadcasters
+        """
+        if self.fanout_mode != 'broadcast' or user.is_staff:
+            return True
+        return self.broadcasters.filter(pk=user.pk).exists()
+    
     def get_other_participant(self, user):
         """
         For direct messages, get the other participant
@@ -95,10 +129,73 @@ class UserProfile(models.Model):
     profile_picture = models.ImageField(upload_to='profile_pics/', null=True, blank=True)
     language = models.CharField(max_length=10, choices=[('en', 'English'), ('ar', 'Arabic')], default='en')
     theme = models.CharField(max_length=10, choices=[('light', 'Light'), ('dark', 'Dark')], default='dark')
+    search_name = models.CharField(max_length=150, blank=True, db_index=True)
     
     def __str__(self):
         return f"{self.user.username} Profile"
     
+    def save(self, *args, **kwargs):
+        # Lowercased username backing the prefix-indexed contact search
+        self.search_name = self.user.username.lower()
+        super().save(*args, **kwargs)
+    
     @property
     def is_online(self):
-        return self.online
\ No newline at end of file
+        return self.online
+
+
+class Contact(models.Model):
+    """
+    Precomputed direct-chat contact of a user, kept up to date as messages
+    are sent so the dashboard never aggregates over the user table
+    """
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contacts')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='contacts')
+    message_count = models.PositiveIntegerField(default=0)
+    last_interaction = models.DateTimeField(default=timezone.now)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'user'], name='unique_contact'),
+        ]
+        indexes = [
+            models.Index(fields=['owner', '-last_interaction']),
+            models.Index(fields=['owner', '-message_count']),
+        ]
+        verbose_name = _('Contact')
+        verbose_name_plural = _('Contacts')
+    
+    def __str__(self):
+        return f"{self.owner.username} -> {self.user.username}"
+
+
+class NotificationDigest(TimeStampedModel):
+    """
+    Messages a participant missed in a room while not connected to it,
+    aggregated into one notification per user per room
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notification_digests')
+    room = models.ForeignKey(ChatRoom, on_delete=models.CASCADE, related_name='notification_digests')
+    message_count = models.PositiveIntegerField(default=1)
+    latest_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    latest_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    latest_preview = models.CharField(max_length=100, blank=True)
+    delivered_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'room'],
+                condition=models.Q(delivered_at__isnull=True),
+                name='unique_pending_digest',
+            ),
+        ]
+        indexes = [
+            models.Index(fields=['user', 'delivered_at']),
+        ]
+        verbose_name = _('Notification Digest')
+        verbose_name_plural = _('Notification Digests')
+    
+    def __str__(self):
+        return f"{self.user.username}: {self.message_count} in {self.room}"
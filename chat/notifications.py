@@ -0,0 +1,192 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import NotificationDigest
+
+
+def room_presence_key(room_id, user_id):
+    return f'chat:presence:room:{room_id}:{user_id}'
+
+
+def notification_presence_key(user_id):
+    return f'chat:presence:notifications:{user_id}'
+
+
+def digest_window():
+    return settings.CHAT_SETTINGS.get('NOTIFICATION_DIGEST_WINDOW', 5)
+
+
+def _presence_timeout():
+    # Bounds how long a counter leaked by a crashed worker can hide a user
+    return settings.CHAT_SETTINGS.get('PRESENCE_TIMEOUT', 3600)
+
+
+def mark_connected(key):
+    cache.add(key, 0, _presence_timeout())
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, _presence_timeout())
+
+
+def refresh_presence(key):
+    """
+    Extend the expiry of a connected socket's presence counter; called
+    periodically for as long as the socket stays open
+    """
+    if not cache.touch(key, _presence_timeout()):
+        # Expired anyway (e.g. the cache was flushed), count this socket again
+        mark_connected(key)
+
+
+def presence_refresh_interval():
+    return _presence_timeout() / 3
+
+
+def mark_disconnected(key):
+    try:
+        if cache.decr(key) <= 0:
+            cache.delete(key)
+    except ValueError:
+        pass
+
+
+def absent_users(room_id, user_ids):
+    """
+    The given users that have no socket connected to the room
+    """
+    keys = {room_presence_key(room_id, user_id): user_id for user_id in user_ids}
+    present = cache.get_many(keys)
+    return [user_id for key, user_id in keys.items() if not present.get(key)]
+
+
+def with_notification_socket(user_ids):
+    """
+    The given users that have a notification socket open
+    """
+    keys = {notification_presence_key(user_id): user_id for user_id in user_ids}
+    present = cache.get_many(keys)
+    return [user_id for key, user_id in keys.items() if present.get(key)]
+
+
+def record_missed_message(message, recipient_ids):
+    """
+    Fold a message into the pending digest of every recipient that is not
+    connected to the room. Returns the users whose digest window this
+    message opened, so the caller can schedule their delivery.
+    """
+    absent = absent_users(message.room_id, recipient_ids)
+    if not absent:
+        return []
+
+    pending = NotificationDigest.objects.filter(
+        room_id=message.room_id,
+        user_id__in=absent,
+        delivered_at__isnull=True,
+    )
+    increment = {
+        'message_count': F('message_count') + 1,
+        'latest_message': message,
+        'latest_sender_id': message.sender_id,
+        'latest_preview': message.content[:100],
+        'modified': timezone.now(),
+    }
+
+    with transaction.atomic():
+        # Locked so a concurrent claim can't deliver a digest between
+        # reading it and counting this message into it
+        existing = set(pending.select_for_update().order_by('id').values_list('user_id', flat=True))
+        if existing:
+            pending.filter(user_id__in=existing).update(**increment)
+
+        opened = [
+            user_id for user_id in absent
+            if user_id not in existing and _open_digest(pending.filter(user_id=user_id), user_id, message, increment)
+        ]
+    return opened
+
+
+def _open_digest(pending, user_id, message, increment):
+    """
+    Create the pending digest of one user. When a concurrent message
+    created it first, count this message into that one instead and return
+    False, so only one delivery gets scheduled.
+    """
+    try:
+        with transaction.atomic():
+            NotificationDigest.objects.create(
+                user_id=user_id,
+                room_id=message.room_id,
+                latest_message=message,
+                latest_sender_id=message.sender_id,
+                latest_preview=increment['latest_preview'],
+            )
+    except IntegrityError:
+        pending.update(**increment)
+        return False
+    return True
+
+
+def serialize_digest(digest):
+    return {
+        'type': 'send_notification',
+        'notification_type': 'message_digest',
+        'room_id': digest.room_id,
+        'room_name': str(digest.room),
+        'count': digest.message_count,
+        'latest_preview': digest.latest_preview,
+        'latest_sender': digest.latest_sender.username if digest.latest_sender else None,
+        'latest_at': digest.modified.isoformat(),
+    }
+
+
+def _claim(digests):
+    """
+    Mark pending digests delivered and return (user_id, event) pairs, in
+    the order the digests were last updated
+    """
+    with transaction.atomic():
+        # Rows stay locked until delivered, so no message is counted into a
+        # digest after its event was built. Locking in id order keeps room
+        # and user claims from deadlocking each other.
+        digests = list(
+            digests.select_for_update(of=('self',))
+            .select_related('room', 'latest_sender')
+            .order_by('id')
+        )
+        if not digests:
+            return []
+        NotificationDigest.objects.filter(
+            id__in=[digest.id for digest in digests],
+        ).update(delivered_at=timezone.now())
+    digests.sort(key=lambda digest: digest.modified)
+    return [(digest.user_id, serialize_digest(digest)) for digest in digests]
+
+
+def claim_room_digests(room_id, user_ids):
+    """
+    Digests of a room that can be pushed now, to users with a
+    notification socket open. The others stay pending for their next
+    connect.
+    """
+    online = with_notification_socket(user_ids)
+    if not online:
+        return []
+    return _claim(NotificationDigest.objects.filter(
+        room_id=room_id,
+        user_id__in=online,
+        delivered_at__isnull=True,
+    ))
+
+
+def claim_user_digests(user_id):
+    """
+    Every digest still pending for a user, claimed when they connect
+    """
+    return _claim(NotificationDigest.objects.filter(
+        user_id=user_id,
+        delivered_at__isnull=True,
+    ))
@@ -0,0 +1,238 @@
+import cProfile
+import functools
+import inspect
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.urls import Resolver404, resolve
+
+
+logger = logging.getLogger(__name__)
+
+CONFIG_KEY = 'chat:profiling:config'
+CONFIG_REFRESH = 5  # seconds a process reuses the runtime config
+SLOW_QUERY_LOG = 'slow_queries.jsonl'
+
+# Name of the view or consumer handler the current code runs under; copied
+# into database_sync_to_async threads so queries can be attributed
+current_handler = ContextVar('current_handler', default=None)
+
+_config = {'expires': 0, 'value': None}
+_active = threading.local()
+
+
+def _settings():
+    return settings.CHAT_SETTINGS.get('PROFILING', {})
+
+
+def profile_dir():
+    return Path(_settings().get('DIR', Path(settings.BASE_DIR) / 'profiles'))
+
+
+def get_config():
+    """
+    The runtime profiling config, set with the chat_profiling command and
+    falling back to CHAT_SETTINGS['PROFILING']
+    """
+    if _config['expires'] < time.monotonic():
+        defaults = {
+            'sample_rate': _settings().get('SAMPLE_RATE', 0),
+            'slow_query_ms': _settings().get('SLOW_QUERY_MS'),
+        }
+        _config['value'] = {**defaults, **(cache.get(CONFIG_KEY) or {})}
+        _config['expires'] = time.monotonic() + CONFIG_REFRESH
+    return _config['value']
+
+
+def set_config(**config):
+    cache.set(CONFIG_KEY, {**(cache.get(CONFIG_KEY) or {}), **config}, None)
+    _config['expires'] = 0
+
+
+def reset_config():
+    cache.delete(CONFIG_KEY)
+    _config['expires'] = 0
+
+
+def _file_name(handler):
+    return re.sub(r'[^\w.]', '_', handler)
+
+
+def _rotate(directory):
+    """
+    Keep only the newest MAX_FILES profiles
+    """
+    profiles = sorted(directory.glob('*.prof'), key=lambda path: path.stat().st_mtime)
+    for path in profiles[:-_settings().get('MAX_FILES', 200)]:
+        path.unlink(missing_ok=True)
+
+
+def _dump(profiler, handler, elapsed):
+    directory = profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f'{time.time():.6f}-{os.getpid()}-{_file_name(handler)}-{elapsed * 1000:.0f}ms.prof'
+    profiler.dump_stats(path)
+    _rotate(directory)
+
+
+@contextmanager
+def profile(handler):
+    """
+    Attribute the enclosed code to a handler and, for a sampled fraction of
+    calls, capture a cProfile of it.
+
+    cProfile hooks the whole thread, so in a consumer the profile also
+    covers other tasks the event loop runs meanwhile, and only one profile
+    runs per thread at a time.
+    """
+    token = current_handler.set(handler)
+    profiler = None
+    if not getattr(_active, 'profiling', False) and random.random() < get_config()['sample_rate']:
+        profiler = cProfile.Profile()
+        _active.profiling = True
+    started = time.perf_counter()
+    try:
+        if profiler:
+            profiler.enable()
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            _active.profiling = False
+            try:
+                _dump(profiler, handler, time.perf_counter() - started)
+            except OSError:
+                logger.exception('Could not write profile of %s', handler)
+        current_handler.reset(token)
+
+
+def profiled(handler):
+    """
+    Decorator version of profile() for sync and async functions
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with profile(handler):
+                    return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with profile(handler):
+                    return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ProfilingMiddleware:
+    """
+    Profiles sampled requests under the name of the view they resolve to;
+    goes first so the time spent in the other middleware is included
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            handler = resolve(request.path_info).view_name
+        except Resolver404:
+            handler = 'not_found'
+        with profile(handler):
+            return self.get_response(request)
+
+
+def log_slow_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper recording queries over the slow query threshold
+    together with the handler that ran them
+    """
+    threshold = get_config()['slow_query_ms']
+    if threshold is None:
+        return execute(sql, params, many, context)
+
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = (time.perf_counter() - started) * 1000
+        if duration >= threshold:
+            entry = {
+                'time': time.time(),
+                'handler': current_handler.get(),
+                'duration_ms': round(duration, 2),
+                'sql': sql,
+            }
+            logger.warning('Slow query in %s (%.0fms): %s', entry['handler'], duration, sql)
+            try:
+                _append_slow_query(entry)
+            except OSError:
+                logger.exception('Could not record slow query')
+
+
+def _append_slow_query(entry):
+    directory = profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / SLOW_QUERY_LOG
+    if path.exists() and path.stat().st_size > _settings().get('SLOW_QUERY_LOG_BYTES', 5 * 1024 * 1024):
+        path.replace(path.with_suffix('.jsonl.1'))
+    with path.open('a') as log:
+        log.write(json.dumps(entry) + '\n')
+
+
+def install_slow_query_logger(sender, connection, **kwargs):
+    if log_slow_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_slow_query)
+
+
+def profile_handler(path):
+    """
+    The (file name safe) handler a profile file was captured for
+    """
+    return path.stem.split('-', 2)[2].rsplit('-', 1)[0]
+
+
+def summarize(handler=None, limit=25, sort='cumulative'):
+    """
+    Text report of the stored profiles, merged per handler, and of the
+    slowest recorded queries
+    """
+    directory = profile_dir()
+    profiles = {}
+    for path in sorted(directory.glob('*.prof')):
+        if handler is None or profile_handler(path) == _file_name(handler):
+            profiles.setdefault(profile_handler(path), []).append(path)
+
+    output = io.StringIO()
+    if not profiles:
+        output.write('No profiles recorded\n')
+    for name, paths in sorted(profiles.items()):
+        output.write(f'== {name}: {len(paths)} profiles ==\n')
+        stats = pstats.Stats(*map(str, paths), stream=output)
+        stats.strip_dirs().sort_stats(sort).print_stats(limit)
+
+    queries = []
+    for path in (directory / (SLOW_QUERY_LOG + '.1'), directory / SLOW_QUERY_LOG):
+        if path.exists():
+            with path.open() as log:
+                queries.extend(json.loads(line) for line in log if line.strip())
+    if handler is not None:
+        queries = [query for query in queries if query['handler'] == handler]
+    if queries:
+        output.write(f'== Slowest of {len(queries)} slow queries ==\n')
+        for query in sorted(queries, key=lambda query: -query['duration_ms'])[:limit]:
+            output.write(f"{query['duration_ms']:>10.1f}ms  {query['handler']}  {query['sql']}\n")
+    return output.getvalue()
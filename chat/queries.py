@@ -0,0 +1,95 @@
+from django.db.models import Count, Max, OuterRef, Q, Subquery
+
+from .fragments import get_versions, room_version_key, user_version_key
+from .models import ChatRoom, Message
+
+
+def load_dashboard_rooms(user):
+    """
+    Chat rooms for the dashboard with everything a room row renders
+    attached, in a fixed number of queries however many rooms there are
+    """
+    through = ChatRoom.participants.through
+
+    participant_count = through.objects.filter(
+        chatroom_id=OuterRef('pk')
+    ).values('chatroom_id').annotate(count=Count('pk')).values('count')
+
+    last_message_id = Message.objects.filter(
+        room_id=OuterRef('pk')
+    ).order_by('-created').values('id')[:1]
+
+    rooms = list(ChatRoom.objects.filter(
+        participants=user,
+        is_active=True
+    ).annotate(
+        last_message_time=Max('messages__created'),
+        unread_count=Count('messages', filter=Q(messages__is_read=False) & ~Q(messages__sender=user)),
+        participant_count=Subquery(participant_count),
+        last_message_id=Subquery(last_message_id),
+    ).order_by('-last_message_time'))
+
+    last_messages = Message.objects.select_related('sender').in_bulk(
+        [room.last_message_id for room in rooms if room.last_message_id]
+    )
+
+    direct_room_ids = [room.id for room in rooms if room.room_type == 'direct']
+    other_users = {}
+    if direct_room_ids:
+        memberships = through.objects.filter(
+            chatroom_id__in=direct_room_ids
+        ).exclude(user_id=user.id).select_related('user__profile')
+        for membership in memberships:
+            other_users.setdefault(membership.chatroom_id, membership.user)
+
+    version_keys = [room_version_key(room.id) for room in rooms]
+    version_keys += [user_version_key(other.id) for other in other_users.values()]
+    versions = get_versions(version_keys) if version_keys else {}
+
+    for room in rooms:
+        room.preload_last_message(last_messages.get(room.last_message_id))
+        room.other_user = other_users.get(room.id)
+        room.fragment_version = versions[room_version_key(room.id)]
+        if room.other_user:
+            room.fragment_version = f'{room.fragment_version}.{versions[user_version_key(room.other_user.id)]}'
+
+    return rooms
+
+
+def load_room_participants(room):
+    """
+    All participants of a room with their profiles
+    """
+    return list(room.participants.select_related('profile').order_by('id'))
+
+
+def load_room_messages(room):
+    """
+    Message queryset for the room view, with the sender rows a message
+    block renders joined in
+    """
+    return room.messages.select_related('sender__profile').order_by('created')
+
+
+def message_block_version(room, messages):
+    """
+    Fragment version of a page of messages: the room's version followed by
+    the versions of the users who sent them
+    """
+    sender_ids = sorted({message.sender_id for message in messages})
+    keys = [room_version_key(room.id)] + [user_version_key(sender_id) for sender_id in sender_ids]
+    versions = get_versions(keys)
+    return '.'.join(str(versions[key]) for key in keys)
+
+
+def get_other_participant(room, participants, user):
+    """
+    ChatRoom.get_other_participant over an already loaded participant list
+    """
+    if room.room_type != 'direct':
+        return None
+    for participant in participants:
+        if participant.id != user.id:
+            return participant
+    return None
+
@@ -0,0 +1,192 @@
+import time
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+
+STATS_KEY = 'chat:ratelimit:stats:{frame_type}:{outcome}'
+STATS_FLUSH_INTERVAL = 10  # seconds
+
+
+def get_frame_limits(frame_type):
+    """
+    Configured {'connection': {...}, 'user': {...}} limits for a frame type
+    """
+    return settings.CHAT_SETTINGS.get('RATE_LIMITS', {}).get(frame_type)
+
+
+class TokenBucket:
+    """
+    Refills `rate` tokens per second up to `burst`
+    """
+
+    def __init__(self, rate, burst, tokens=None, updated=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def refill(self, now):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.updated = now
+
+    def check(self, now=None):
+        """
+        Returns None when a token is available, otherwise the number of
+        seconds until there is one
+        """
+        self.refill(time.time() if now is None else now)
+        if self.tokens >= 1:
+            return None
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now=None):
+        """
+        Take one token. Returns None when allowed, otherwise the number of
+        seconds until a token is available.
+        """
+        retry_after = self.check(now)
+        if retry_after is None:
+            self.tokens -= 1
+        return retry_after
+
+
+class RateLimitStats:
+    """
+    Process-local allowed/limited counters, periodically added to shared
+    cache counters so limits can be tuned from real traffic
+    """
+
+    def __init__(self):
+        self.pending = Counter()
+        self.last_flush = time.monotonic()
+
+    def record(self, frame_type, outcome):
+        self.pending[(frame_type, outcome)] += 1
+
+    def should_flush(self):
+        return self.pending and time.monotonic() - self.last_flush >= STATS_FLUSH_INTERVAL
+
+    async def flush(self):
+        pending, self.pending = self.pending, Counter()
+        self.last_flush = time.monotonic()
+        await sync_to_async(self.add_counts, thread_sensitive=False)(pending)
+
+    def add_counts(self, pending):
+        for (frame_type, outcome), count in pending.items():
+            key = STATS_KEY.format(frame_type=frame_type, outcome=outcome)
+            if not cache.add(key, count, None):
+                cache.incr(key, count)
+
+
+stats = RateLimitStats()
+
+
+def read_stats():
+    """
+    Shared counters as {frame_type: {'allowed': n, 'limited': n}}
+    """
+    frame_types = settings.CHAT_SETTINGS.get('RATE_LIMITS', {})
+    keys = {
+        STATS_KEY.format(frame_type=frame_type, outcome=outcome): (frame_type, outcome)
+        for frame_type in frame_types
+        for outcome in ('allowed', 'limited')
+    }
+    values = cache.get_many(keys)
+    result = {frame_type: {'allowed': 0, 'limited': 0} for frame_type in frame_types}
+    for key, (frame_type, outcome) in keys.items():
+        result[frame_type][outcome] = values.get(key, 0)
+    return result
+
+
+def reset_stats():
+    cache.delete_many([
+        STATS_KEY.format(frame_type=frame_type, outcome=outcome)
+        for frame_type in settings.CHAT_SETTINGS.get('RATE_LIMITS', {})
+        for outcome in ('allowed', 'limited')
+    ])
+
+
+class ConnectionRateLimiter:
+    """
+    Token buckets for one WebSocket connection, plus the user's buckets
+    shared across all of their connections through the cache
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.buckets = {}
+
+    def connection_bucket(self, frame_type, limit):
+        bucket = self.buckets.get(frame_type)
+        if bucket is None:
+            bucket = self.buckets[frame_type] = TokenBucket(limit['rate'], limit['burst'])
+        return bucket
+
+    async def consume_user_bucket(self, frame_type, limit):
+        # Sync cache.incr is atomic, the async one is a get followed by a set.
+        # Off the thread database_sync_to_async shares, so a flooding client
+        # doesn't queue up in front of other consumers' queries.
+        return await sync_to_async(self.consume_user_window, thread_sensitive=False)(frame_type, limit)
+
+    def consume_user_window(self, frame_type, limit):
+        """
+        The user's bucket, approximated by a sliding window of burst / rate
+        seconds over two cache counters. The counters only change through
+        incr and decr, so concurrent sockets of a user each get their own
+        count and never spend the same token.
+        """
+        window = limit['burst'] / limit['rate']
+        index, elapsed = divmod(time.time(), window)
+        key = f'chat:ratelimit:user:{self.user_id}:{frame_type}:{int(index)}'
+        timeout = int(2 * window) + 1
+
+        cache.add(key, 0, timeout)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # Expired between add and incr
+            cache.set(key, 1, timeout)
+            count = 1
+        previous = cache.get(f'chat:ratelimit:user:{self.user_id}:{frame_type}:{int(index) - 1}', 0)
+
+        # The previous window counts for the part still inside the sliding window
+        weight = 1 - elapsed / window
+        excess = previous * weight + count - limit['burst']
+        if excess <= 0:
+            return None
+
+        # Limited frames don't use up the window
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass
+        if previous:
+            return min(excess * window / previous, window - elapsed)
+        return window - elapsed
+
+    async def check(self, frame_type):
+        """
+        Returns None when the frame may be processed, otherwise the number
+        of seconds the client should wait
+        """
+        limits = get_frame_limits(frame_type)
+        if not limits:
+            return None
+
+        # Check the connection bucket first and only spend its token once
+        # the user window accepted the frame
+        bucket = self.connection_bucket(frame_type, limits['connection']) if 'connection' in limits else None
+        retry_after = bucket.check() if bucket else None
+        if retry_after is None and 'user' in limits:
+            retry_after = await self.consume_user_bucket(frame_type, limits['user'])
+        if retry_after is None and bucket:
+            bucket.consume()
+
+        stats.record(frame_type, 'allowed' if retry_after is None else 'limited')
+        if stats.should_flush():
+            await stats.flush()
+        return retry_after
@@ -0,0 +1,152 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .contacts import invalidate_contacts
+from .fragments import bump_room_version
+from .models import ChatRoom, Contact, Message
+
+
+CHECKPOINT_KEY = 'chat:retention:checkpoint'
+
+
+def get_policy(room_type):
+    return settings.CHAT_SETTINGS.get('RETENTION', {}).get(room_type, {})
+
+
+def message_cutoff(room, now=None):
+    """
+    Messages of the room created before this moment are expired, None
+    when the room keeps its messages forever
+    """
+    days = room.retention_days
+    if days is None:
+        days = get_policy(room.room_type).get('MESSAGE_DAYS')
+    if days is None:
+        return None
+    return (now or timezone.now()) - timedelta(days=days)
+
+
+def rooms_with_expired_messages():
+    """
+    Rooms that have a message retention period, by their own setting or
+    their room type's policy
+    """
+    room_types = [
+        room_type for room_type, _ in ChatRoom.ROOM_TYPES
+        if get_policy(room_type).get('MESSAGE_DAYS') is not None
+    ]
+    return ChatRoom.objects.filter(
+        Q(retention_days__isnull=False) | Q(room_type__in=room_types)
+    ).order_by('id')
+
+
+def expired_inactive_rooms(now=None):
+    """
+    Inactive rooms untouched for longer than their room type allows
+    """
+    now = now or timezone.now()
+    condition = Q(pk__in=[])
+    for room_type, _ in ChatRoom.ROOM_TYPES:
+        days = get_policy(room_type).get('INACTIVE_ROOM_DAYS')
+        if days is not None:
+            condition |= Q(room_type=room_type, modified__lt=now - timedelta(days=days))
+    return ChatRoom.objects.filter(condition, is_active=False).order_by('id')
+
+
+class Purger:
+    """
+    Deletes expired messages and rooms in bounded primary-key ranges,
+    sleeping between batches so the purge never holds long locks.
+
+    Deleting is idempotent, and the last fully purged room is kept as a
+    checkpoint so an interrupted run can resume where it stopped.
+    """
+
+    def __init__(self, batch_size=1000, sleep=0.1, dry_run=False, progress=None):
+        self.batch_size = batch_size
+        self.sleep = sleep
+        self.dry_run = dry_run
+        self.progress = progress or (lambda message: None)
+        self.now = timezone.now()
+
+    def delete_batches(self, room, messages):
+        """
+        Delete the given messages of one room, batch_size primary keys at a
+        time, keeping counters and caches of the room consistent
+        """
+        deleted = 0
+        while True:
+            ids = list(messages.order_by('id').values_list('id', flat=True)[:self.batch_size])
+            if not ids:
+                break
+            if self.dry_run:
+                # Nothing gets deleted, so count the rest in one go
+                return deleted + messages.count()
+
+            _, per_model = messages.filter(id__gte=ids[0], id__lte=ids[-1]).delete()
+            count = per_model.get(Message._meta.label, 0)
+            deleted += count
+            self.after_delete(room, count)
+            self.progress(f'room {room.id}: deleted {deleted} messages')
+            # Pause after every batch, rooms with a single batch included
+            time.sleep(self.sleep)
+            if len(ids) < self.batch_size:
+                break
+        return deleted
+
+    def after_delete(self, room, count):
+        if room.room_type == 'direct':
+            contacts = Contact.objects.filter(room=room)
+            contacts.update(message_count=Greatest(F('message_count') - count, 0))
+            invalidate_contacts(contacts.values_list('owner_id', flat=True))
+        bump_room_version(room.id)
+
+    def purge_messages(self, after_room_id=None):
+        rooms = rooms_with_expired_messages()
+        if after_room_id is not None:
+            rooms = rooms.filter(id__gt=after_room_id)
+
+        total = 0
+        for room in rooms.iterator():
+            cutoff = message_cutoff(room, self.now)
+            if cutoff is not None:
+                total += self.delete_batches(room, Message.objects.filter(room=room, created__lt=cutoff))
+            if not self.dry_run:
+                cache.set(CHECKPOINT_KEY, room.id, None)
+        return total
+
+    def purge_inactive_rooms(self):
+        """
+        Empty and delete expired inactive rooms, returning the number of
+        messages and rooms deleted
+        """
+        messages = rooms = 0
+        for room in expired_inactive_rooms(self.now).iterator():
+            messages += self.delete_batches(room, Message.objects.filter(room=room))
+            if not self.dry_run:
+                participant_ids = list(room.participants.values_list('id', flat=True))
+                room.delete()
+                invalidate_contacts(participant_ids)
+                bump_room_version(room.id)
+                time.sleep(self.sleep)
+            rooms += 1
+            self.progress(f'room {room.id}: deleted inactive room')
+        return messages, rooms
+
+    def run(self, resume=False):
+        after_room_id = cache.get(CHECKPOINT_KEY) if resume else None
+        if after_room_id is not None:
+            self.progress(f'resuming after room {after_room_id}')
+
+        messages = self.purge_messages(after_room_id)
+        room_messages, rooms = self.purge_inactive_rooms()
+        messages += room_messages
+        if not self.dry_run:
+            cache.delete(CHECKPOINT_KEY)
+        return messages, rooms
@@ -0,0 +1,47 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.signals import user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .auth import invalidate_cached_user
+from .contacts import record_message
+from .fragments import bump_room_version, bump_user_version
+from .models import Message, UserProfile
+
+
+@receiver(post_save, sender=Message)
+def message_created(sender, instance, created, **kwargs):
+    """
+    Keep denormalized per-user data in step with new messages
+    """
+    if created:
+        record_message(instance)
+        bump_room_version(instance.room_id)
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    invalidate_cached_user(instance.id)
+    bump_user_version(instance.id)
+
+
+@receiver(post_save, sender=User)
+def user_renamed(sender, instance, created, **kwargs):
+    """
+    Keep the profile's search_name in step with a renamed username
+    """
+    if not created:
+        search_name = instance.username.lower()
+        UserProfile.objects.filter(user=instance).exclude(search_name=search_name).update(search_name=search_name)
+
+
+@receiver([post_save, post_delete], sender=UserProfile)
+def profile_changed(sender, instance, **kwargs):
+    invalidate_cached_user(instance.user_id)
+    bump_user_version(instance.user_id)
+
+
+@receiver(user_logged_out)
+def user_logged_out_handler(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_cached_user(user.id)
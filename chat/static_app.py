@@ -0,0 +1,124 @@
+import mimetypes
+import os
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.utils._os import safe_join
+
+
+IMMUTABLE_CACHE_CONTROL = b'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = b'public, max-age=0, must-revalidate'
+
+ENCODINGS = (
+    ('br', '.br'),
+    ('gzip', '.gz'),
+)
+
+
+def accepted_encodings(headers):
+    """
+    Parse the Accept-Encoding header into a set of codings the client takes
+    """
+    for key, value in headers:
+        if key == b'accept-encoding':
+            codings = set()
+            for item in value.decode('latin-1').split(','):
+                coding, _, params = item.partition(';')
+                params = params.replace(' ', '')
+                if params.startswith('q='):
+                    try:
+                        if float(params[2:]) <= 0:
+                            continue
+                    except ValueError:
+                        pass
+                codings.add(coding.strip().lower())
+            return codings
+    return set()
+
+
+def header_value(headers, name):
+    for key, value in headers:
+        if key == name:
+            return value
+    return None
+
+
+class StaticFilesApp:
+    """
+    ASGI wrapper serving STATIC_ROOT directly, picking a precompressed
+    variant by Accept-Encoding and marking hashed files immutable
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.prefix = '/' + settings.STATIC_URL.strip('/') + '/'
+        self.root = str(settings.STATIC_ROOT)
+        self.immutable_names = set(getattr(staticfiles_storage, 'hashed_files', {}).values())
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            return await self.application(scope, receive, send)
+
+        if scope['method'] not in ('GET', 'HEAD'):
+            return await self.respond(send, 405, [(b'allow', b'GET, HEAD')])
+
+        name = scope['path'][len(self.prefix):]
+        response = await self.lookup(name, scope['headers'])
+        if response is None:
+            return await self.application(scope, receive, send)
+
+        status, headers, body = response
+        if scope['method'] == 'HEAD':
+            body = b''
+        await self.respond(send, status, headers, body)
+
+    @sync_to_async(thread_sensitive=False)
+    def lookup(self, name, request_headers):
+        try:
+            path = safe_join(self.root, name)
+        except SuspiciousFileOperation:
+            return None
+        if not os.path.isfile(path):
+            return None
+
+        content_type, _ = mimetypes.guess_type(path)
+        headers = [
+            (b'content-type', (content_type or 'application/octet-stream').encode()),
+            (b'vary', b'Accept-Encoding'),
+        ]
+        if name in self.immutable_names:
+            headers.append((b'cache-control', IMMUTABLE_CACHE_CONTROL))
+        else:
+            headers.append((b'cache-control', REVALIDATE_CACHE_CONTROL))
+
+        codings = accepted_encodings(request_headers)
+        for coding, suffix in ENCODINGS:
+            if coding in codings and os.path.isfile(path + suffix):
+                path = path + suffix
+                headers.append((b'content-encoding', coding.encode()))
+                break
+
+        stat = os.stat(path)
+        etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'.encode()
+        headers.append((b'etag', etag))
+
+        if header_value(request_headers, b'if-none-match') == etag:
+            return 304, headers, b''
+
+        with open(path, 'rb') as static_file:
+            body = static_file.read()
+        headers.append((b'content-length', str(len(body)).encode()))
+        return 200, headers, body
+
+    async def respond(self, send, status, headers, body=b''):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers,
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': body,
+        })
@@ -0,0 +1,77 @@
+import gzip
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files.base import ContentFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.html', '.xml')
+
+
+def get_minifier(name):
+    """
+    Return the minifier for a static file name, if one is installed
+    """
+    if '.min.' in name:
+        return None
+    if name.endswith('.css') and rcssmin:
+        return rcssmin.cssmin
+    if name.endswith('.js') and rjsmin:
+        return rjsmin.jsmin
+    return None
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Manifest storage that minifies CSS/JS and writes .gz and .br variants
+    of every hashed file next to it
+    """
+
+    def _save(self, name, content):
+        minifier = get_minifier(name)
+        if minifier:
+            # Hashing may have left the file positioned at its end
+            content.seek(0)
+            source = content.read().decode('utf-8')
+            content = ContentFile(minifier(source).encode('utf-8'))
+        return super()._save(name, content)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+
+        for hashed_name in set(self.hashed_files.values()):
+            if hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self.compress(hashed_name)
+
+    def compress(self, name):
+        with self.open(name) as original_file:
+            data = original_file.read()
+
+        variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+        if brotli:
+            variants.append(('.br', brotli.compress(data)))
+
+        for suffix, compressed in variants:
+            # Not worth serving a variant that isn't smaller
+            if len(compressed) >= len(data):
+                continue
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            # Bypass _save's minification, the bytes are already final
+            super()._save(name + suffix, ContentFile(compressed))
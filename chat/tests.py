@@ -1,3 +1,1039 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import os
+import subprocess
+import sys
+from collections import Counter
+from datetime import timedelta
+from importlib import import_module
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from daphne.utils import parse_x_forwarded_for
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.db.models import QuerySet
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import notifications
+from .auth import resolve_user
+from .consumers import ChatConsumer, NotificationConsumer
+from .contacts import get_contact_directory, rebuild_contacts, record_direct_chat, search_users
+from .fanout import is_large_room, member_group_name, room_group_names
+from .layers import AffinityChannelLayer
+from .management.commands.runworkers import Command as RunWorkersCommand, forwarded_head
+from .models import ChatRoom, Contact, Message, NotificationDigest, UserProfile
+from .notifications import absent_users, claim_user_digests, record_missed_message
+from .profiling import reset_config, set_config, summarize
+from .ratelimit import ConnectionRateLimiter, TokenBucket
+from .retention import CHECKPOINT_KEY, Purger
+from .static_app import StaticFilesApp
+from .workers import group_room_id, path_room_id, room_worker
+
+
+class FanoutGroupTests(TestCase):
+
+    def test_flat_room_uses_one_group(self):
+        self.assertEqual(room_group_names(7, 'flat'), ['chat_7'])
+        self.assertEqual(member_group_name(7, 'flat', 'specific.abc'), 'chat_7')
+
+    def test_sharded_members_spread_over_all_shards(self):
+        groups = room_group_names(7, 'sharded', shards=4)
+        self.assertEqual(groups, ['chat_7_s0', 'chat_7_s1', 'chat_7_s2', 'chat_7_s3'])
+
+        members = Counter(
+            member_group_name(7, 'sharded', f'specific.inmemory!{index}', shards=4)
+            for index in range(400)
+        )
+        self.assertEqual(set(members), set(groups))
+        self.assertTrue(all(50 <= count <= 150 for count in members.values()))
+        # A connection always lands in the same shard
+        self.assertEqual(
+            member_group_name(7, 'sharded', 'specific.inmemory!1', shards=4),
+            member_group_name(7, 'sharded', 'specific.inmemory!1', shards=4),
+        )
+
+    @override_settings(CHAT_SETTINGS={'LARGE_ROOM_THRESHOLD': 3})
+    def test_create_group_chat_picks_fanout_mode_by_size(self):
+        self.assertFalse(is_large_room(2))
+        self.assertTrue(is_large_room(3))
+
+        creator = User.objects.create_user('alice', password='secret')
+        members = [User.objects.create_user(f'user{index}', password='secret') for index in range(2)]
+        self.client.force_login(creator)
+
+        self.client.post(reverse('chat:create_group_chat'), {'name': 'small', 'participants': [members[0].id]})
+        self.client.post(reverse('chat:create_group_chat'), {'name': 'large', 'participants': [m.id for m in members]})
+
+        self.assertEqual(ChatRoom.objects.get(name='small').fanout_mode, 'flat')
+        self.assertEqual(ChatRoom.objects.get(name='large').fanout_mode, 'sharded')
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class FanoutConsumerTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.users = [User.objects.create_user(username, password='secret') for username in ('alice', 'bob')]
+
+    def create_room(self, fanout_mode):
+        room = ChatRoom.objects.create(name='big', room_type='group', fanout_mode=fanout_mode)
+        room.participants.add(*self.users)
+        return room
+
+    def communicator(self, room, user):
+        communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{room.id}/')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'room_id': str(room.id)}}
+        return communicator
+
+    def test_broadcast_room_skips_presence_and_typing(self):
+        room = self.create_room('broadcast')
+        room.broadcasters.add(self.users[1])
+
+        async def run():
+            alice, bob = (self.communicator(room, user) for user in self.users)
+            await alice.connect()
+            await bob.connect()
+            await bob.send_json_to({'type': 'typing', 'is_typing': True})
+            quiet = await alice.receive_nothing(timeout=0.3)
+
+            await bob.send_json_to({'type': 'chat_message', 'message': 'hello'})
+            message = await alice.receive_json_from()
+            await bob.disconnect()
+            quiet_after_leave = await alice.receive_nothing(timeout=0.3)
+            await alice.disconnect()
+            return quiet, message, quiet_after_leave
+
+        quiet, message, quiet_after_leave = async_to_sync(run)()
+        self.assertTrue(quiet)
+        self.assertEqual((message['type'], message['content']), ('chat_message', 'hello'))
+        self.assertTrue(quiet_after_leave)
+
+    def test_broadcast_room_is_read_only_and_skips_read_receipts(self):
+        room = self.create_room('broadcast')
+        message = Message.objects.create(room=room, sender=self.users[1], content='news')
+
+        async def run():
+            alice, bob = (self.communicator(room, user) for user in self.users)
+            await alice.connect()
+            await bob.connect()
+            await alice.send_json_to({'type': 'chat_message', 'message': 'hi all'})
+            error = await alice.receive_json_from()
+
+            await alice.send_json_to({'type': 'read_receipt', 'message_id': message.id})
+            quiet = await bob.receive_nothing(timeout=0.3)
+            await alice.disconnect()
+            await bob.disconnect()
+            return error, quiet
+
+        error, quiet = async_to_sync(run)()
+        self.assertEqual((error['type'], error['code']), ('error', 'read_only'))
+        self.assertTrue(quiet)
+        self.assertEqual(list(room.messages.values_list('content', 'is_read')), [('news', True)])
+
+    def test_admin_sets_fanout_mode_and_broadcasters(self):
+        room = self.create_room('flat')
+        admin_user = User.objects.create_superuser('admin', password='secret')
+        self.client.force_login(admin_user)
+
+        response = self.client.post(reverse('admin:chat_chatroom_change', args=[room.id]), {
+            'name': 'announcements',
+            'room_type': 'group',
+            'participants': [user.id for user in self.users],
+            'is_active': 'on',
+            'fanout_mode': 'broadcast',
+            'broadcasters': [self.users[0].id],
+        })
+
+        self.assertEqual(response.status_code, 302)
+        room.refresh_from_db()
+        self.assertEqual(room.fanout_mode, 'broadcast')
+        self.assertTrue(room.can_post(self.users[0]))
+        self.assertFalse(room.can_post(self.users[1]))
+
+    @override_settings(CHAT_SETTINGS={**settings.CHAT_SETTINGS, 'FANOUT_SHARDS': 4})
+    def test_sharded_room_reaches_every_shard(self):
+        room = self.create_room('sharded')
+
+        async def run():
+            communicators = [self.communicator(room, self.users[index % 2]) for index in range(8)]
+            for communicator in communicators:
+                await communicator.connect()
+            groups = {group for group in get_channel_layer().groups if group.startswith(f'chat_{room.id}_s')}
+
+            await communicators[0].send_json_to({'type': 'chat_message', 'message': 'hello'})
+            received = []
+            for communicator in communicators:
+                while True:
+                    frame = await communicator.receive_json_from()
+                    if frame['type'] == 'chat_message':
+                        received.append(frame['content'])
+                        break
+                await communicator.disconnect()
+            return groups, received
+
+        groups, received = async_to_sync(run)()
+        self.assertGreater(len(groups), 1)
+        self.assertEqual(received, ['hello'] * 8)
+
+
+SCRIPT = """
+// Comments and indentation are stripped by the minifier
+function greet(name) {
+    return 'Hello, ' + name + '!';
+}
+""" * 20
+
+
+async def fallback_app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 404, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b'django'})
+
+
+class StaticPipelineTests(SimpleTestCase):
+
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        source = Path(directory.name) / 'source'
+        source.mkdir()
+        (source / 'app.js').write_text(SCRIPT)
+        self.root = Path(directory.name) / 'root'
+
+        static_settings = override_settings(
+            STATIC_ROOT=self.root,
+            STATICFILES_DIRS=[source],
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+            STORAGES={
+                **settings.STORAGES,
+                'staticfiles': {'BACKEND': 'chat.storage.CompressedManifestStaticFilesStorage'},
+            },
+        )
+        static_settings.enable()
+        self.addCleanup(static_settings.disable)
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.hashed_name = staticfiles_storage.stored_name('app.js')
+        self.app = StaticFilesApp(fallback_app)
+
+    def request(self, path, method='GET', headers=()):
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path, 'headers': list(headers)}
+        async_to_sync(self.app)(scope, receive, send)
+        return messages[0]['status'], dict(messages[0]['headers']), messages[1]['body']
+
+    def test_collectstatic_minifies_hashes_and_compresses(self):
+        self.assertNotEqual(self.hashed_name, 'app.js')
+        minified = (self.root / self.hashed_name).read_bytes()
+        self.assertNotIn(b'Comments', minified)
+        self.assertLess(len(minified), len(SCRIPT))
+        self.assertEqual(gzip.decompress((self.root / (self.hashed_name + '.gz')).read_bytes()), minified)
+        self.assertTrue((self.root / (self.hashed_name + '.br')).exists())
+
+    def test_serves_precompressed_variant_by_accept_encoding(self):
+        path = f'/static/{self.hashed_name}'
+        for accept_encoding, coding in (
+            (b'gzip, deflate, br', b'br'),
+            (b'gzip, br;q=0', b'gzip'),
+            (b'identity', None),
+        ):
+            status, headers, body = self.request(path, headers=[(b'accept-encoding', accept_encoding)])
+            self.assertEqual(status, 200)
+            self.assertEqual(headers.get(b'content-encoding'), coding)
+            self.assertEqual(headers[b'content-length'], str(len(body)).encode())
+            self.assertEqual(headers[b'vary'], b'Accept-Encoding')
+
+    def test_hashed_files_are_immutable(self):
+        _, hashed, _ = self.request(f'/static/{self.hashed_name}')
+        _, unhashed, _ = self.request('/static/app.js')
+
+        self.assertIn(b'immutable', hashed[b'cache-control'])
+        self.assertIn(b'must-revalidate', unhashed[b'cache-control'])
+
+    def test_etag_revalidation_and_head(self):
+        path = f'/static/{self.hashed_name}'
+        _, headers, body = self.request(path)
+
+        status, _, not_modified = self.request(path, headers=[(b'if-none-match', headers[b'etag'])])
+        self.assertEqual((status, not_modified), (304, b''))
+
+        status, head_headers, head_body = self.request(path, method='HEAD')
+        self.assertEqual((status, head_body), (200, b''))
+        self.assertEqual(head_headers[b'content-length'], str(len(body)).encode())
+
+    def test_rejects_other_methods_and_escaping_paths(self):
+        status, headers, _ = self.request(f'/static/{self.hashed_name}', method='POST')
+        self.assertEqual((status, headers[b'allow']), (405, b'GET, HEAD'))
+
+        for path in ('/static/../source/app.js', '/static/missing.js', '/room/1/'):
+            self.assertEqual(self.request(path), (404, {}, b'django'))
+
+    def test_asgi_application_loads(self):
+        # A fresh interpreter, as daphne imports the module before Django is set up
+        result = subprocess.run(
+            [sys.executable, '-c', 'import chat_app.asgi'],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': 'chat_app.settings'},
+            capture_output=True,
+            text=True,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+
+class ContactDirectoryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = self.create_user('alice')
+        self.client.force_login(self.user)
+
+    def create_user(self, username):
+        user = User.objects.create_user(username, password='secret')
+        UserProfile.objects.create(user=user)
+        return user
+
+    def create_direct_room(self, other, messages=0):
+        room = ChatRoom.objects.create(room_type='direct')
+        room.participants.add(self.user, other)
+        record_direct_chat(room, self.user, other)
+        for index in range(messages):
+            Message.objects.create(room=room, sender=other, content=f'hello {index}')
+        return room
+
+    def search(self, query, **kwargs):
+        results, next_cursor = search_users(self.user, query, **kwargs)
+        return [result['username'] for result in results], next_cursor
+
+    def test_search_matches_username_prefix(self):
+        for username in ('Bob', 'bobby', 'rob'):
+            self.create_user(username)
+
+        self.assertEqual(self.search('BO'), (['Bob', 'bobby'], None))
+        self.assertEqual(self.search('al'), ([], None))
+
+    def test_search_pages_by_cursor(self):
+        for index in range(5):
+            self.create_user(f'user{index}')
+
+        first, cursor = self.search('user', limit=2)
+        second, cursor = self.search('user', limit=2, cursor=cursor)
+        third, cursor = self.search('user', limit=2, cursor=cursor)
+
+        self.assertEqual(first + second + third, [f'user{index}' for index in range(5)])
+        self.assertIsNone(cursor)
+
+    def test_search_escapes_wildcards(self):
+        for username in ('a%b', 'a_b', 'axb'):
+            self.create_user(username)
+
+        self.assertEqual(self.search('a%')[0], ['a%b'])
+        self.assertEqual(self.search('a_')[0], ['a_b'])
+
+    def test_search_follows_renamed_user(self):
+        bob = self.create_user('bob')
+        bob.username = 'zed'
+        bob.save()
+
+        self.assertEqual(self.search('zed')[0], ['zed'])
+        self.assertEqual(self.search('bob')[0], [])
+
+    def test_messages_update_contact_counters(self):
+        bob = self.create_user('bob')
+        room = self.create_direct_room(bob, messages=3)
+        group = ChatRoom.objects.create(name='group', room_type='group')
+        group.participants.add(self.user, bob)
+        Message.objects.create(room=group, sender=bob, content='not counted')
+
+        contact = Contact.objects.get(owner=self.user, user=bob)
+        self.assertEqual(contact.message_count, 3)
+        self.assertEqual(contact.last_interaction, room.messages.latest('created').created)
+        self.assertEqual(Contact.objects.get(owner=bob, user=self.user).message_count, 3)
+
+    def test_directory_cache_is_invalidated_by_new_messages(self):
+        bob = self.create_user('bob')
+        room = self.create_direct_room(bob)
+        self.assertEqual(get_contact_directory(self.user)['recent'][0]['message_count'], 0)
+
+        Message.objects.create(room=room, sender=bob, content='hi')
+
+        self.assertEqual(get_contact_directory(self.user)['recent'][0]['message_count'], 1)
+
+    def test_rebuild_contacts_recomputes_counters(self):
+        bob = self.create_user('bob')
+        room = self.create_direct_room(bob, messages=2)
+        Contact.objects.all().delete()
+        carol = self.create_user('carol')
+        other_room = ChatRoom.objects.create(room_type='direct')
+        other_room.participants.add(self.user, carol)
+
+        self.assertEqual(rebuild_contacts(batch_size=1), 4)
+
+        contact = Contact.objects.get(owner=self.user, user=bob)
+        self.assertEqual((contact.room, contact.message_count), (room, 2))
+        self.assertEqual(Contact.objects.get(owner=carol, user=self.user).message_count, 0)
+
+    def test_migration_backfills_contacts_of_existing_rooms(self):
+        bob = self.create_user('bob')
+        room = self.create_direct_room(bob, messages=2)
+        Contact.objects.all().delete()
+
+        backfill = import_module('chat.migrations.0007_backfill_contacts').backfill_contacts
+        backfill(django_apps, None)
+
+        contact = Contact.objects.get(owner=bob, user=self.user)
+        self.assertEqual((contact.room, contact.message_count), (room, 2))
+        self.assertEqual(contact.last_interaction, room.messages.latest('created').created)
+        self.assertEqual(Contact.objects.count(), 2)
+
+    def test_contacts_endpoint(self):
+        bob = self.create_user('bob')
+        room = self.create_direct_room(bob, messages=1)
+
+        data = self.client.get(reverse('chat:contacts')).json()
+
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(data['recent'][0]['username'], 'bob')
+        self.assertEqual(data['frequent'][0]['room_id'], room.id)
+
+    def test_contact_search_endpoint(self):
+        for index in range(3):
+            self.create_user(f'user{index}')
+
+        first = self.client.get(reverse('chat:contact_search'), {'q': 'user', 'limit': 2}).json()
+        second = self.client.get(
+            reverse('chat:contact_search'), {'q': 'user', 'limit': 2, 'cursor': first['next_cursor']}
+        ).json()
+
+        self.assertEqual([user['username'] for user in first['results']], ['user0', 'user1'])
+        self.assertEqual([user['username'] for user in second['results']], ['user2'])
+        self.assertIsNone(second['next_cursor'])
+
+    def test_start_chat_creates_contacts(self):
+        bob = self.create_user('bob')
+        self.assertContains(self.client.get(reverse('chat:index')), reverse('chat:contact_search'))
+
+        response = self.client.get(reverse('chat:start_chat', args=[bob.id]))
+
+        room = ChatRoom.objects.get(room_type='direct', participants=bob)
+        self.assertRedirects(response, reverse('chat:room_detail', args=[room.id]))
+        self.assertEqual(get_contact_directory(self.user)['recent'][0]['username'], 'bob')
+
+
+class ViewQueryCountTests(TestCase):
+    """
+    The dashboard and room views must issue a fixed number of queries no
+    matter how many rooms, members or messages they render
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='secret')
+        UserProfile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def create_direct_room(self, index):
+        other = User.objects.create_user(f'user{index}', password='secret')
+        UserProfile.objects.create(user=other)
+        room = ChatRoom.objects.create(room_type='direct')
+        room.participants.add(self.user, other)
+        Message.objects.create(room=room, sender=other, content=f'hello {index}')
+        return room, other
+
+    def create_group_room(self, members):
+        room = ChatRoom.objects.create(name='group', room_type='group')
+        room.participants.add(self.user, *members)
+        for member in members:
+            Message.objects.create(room=room, sender=member, content=f'hi from {member.username}')
+        return room
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_index_query_count_is_constant(self):
+        self.create_direct_room(0)
+        baseline = self.count_queries(reverse('chat:index'))
+
+        members = [self.create_direct_room(index)[1] for index in range(1, 6)]
+        self.create_group_room(members)
+
+        self.assertEqual(self.count_queries(reverse('chat:index')), baseline)
+
+    def test_index_queries(self):
+        for index in range(5):
+            self.create_direct_room(index)
+        cache.clear()
+
+        # session, user, profile, rooms, last messages, other participants,
+        # contacts (recent, frequent, count), request.user.profile in base.html
+        with self.assertNumQueries(10):
+            response = self.client.get(reverse('chat:index'))
+        self.assertContains(response, 'hello 4')
+        self.assertContains(response, 'user4')
+
+    def test_room_detail_query_count_is_constant(self):
+        room, other = self.create_direct_room(0)
+        url = reverse('chat:room_detail', args=[room.id])
+        baseline = self.count_queries(url)
+
+        for index in range(10):
+            Message.objects.create(room=room, sender=other, content=f'more {index}')
+            Message.objects.create(room=room, sender=self.user, content=f'reply {index}')
+
+        self.assertEqual(self.count_queries(url), baseline)
+
+    def test_group_room_detail_query_count_is_constant(self):
+        members = [self.create_direct_room(index)[1] for index in range(2)]
+        small_room = self.create_group_room(members)
+        baseline = self.count_queries(reverse('chat:room_detail', args=[small_room.id]))
+
+        members = [self.create_direct_room(index)[1] for index in range(2, 12)]
+        large_room = self.create_group_room(members)
+
+        self.assertEqual(self.count_queries(reverse('chat:room_detail', args=[large_room.id])), baseline)
+
+    def test_new_message_invalidates_cached_room_row(self):
+        room, other = self.create_direct_room(0)
+        self.client.get(reverse('chat:index'))
+
+        Message.objects.create(room=room, sender=other, content='fresh message')
+
+        response = self.client.get(reverse('chat:index'))
+        self.assertContains(response, 'fresh message')
+
+    def test_sender_change_invalidates_cached_message_block(self):
+        members = [self.create_direct_room(index)[1] for index in range(2)]
+        room = self.create_group_room(members)
+        url = reverse('chat:room_detail', args=[room.id])
+        self.client.get(url)
+
+        members[0].first_name, members[0].last_name = 'Renamed', 'Member'
+        members[0].save()
+
+        # In the member list and on the member's message
+        self.assertContains(self.client.get(url), 'Renamed Member', count=2)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class RateLimitTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='secret')
+        self.room = ChatRoom.objects.create(room_type='direct')
+        self.room.participants.add(self.user)
+
+    def test_token_bucket_refills(self):
+        bucket = TokenBucket(rate=1, burst=2, updated=100)
+        self.assertIsNone(bucket.consume(now=100))
+        self.assertIsNone(bucket.consume(now=100))
+        self.assertAlmostEqual(bucket.consume(now=100), 1)
+        self.assertIsNone(bucket.consume(now=101))
+
+    @override_settings(CHAT_SETTINGS={
+        'RATE_LIMITS': {'typing': {'user': {'rate': 1, 'burst': 3}}},
+    })
+    def test_user_limit_is_shared_across_connections(self):
+        async def run():
+            limiters = [ConnectionRateLimiter(self.user.id), ConnectionRateLimiter(self.user.id)]
+            with mock.patch('chat.ratelimit.time.time', return_value=1000.5):
+                return await asyncio.gather(*(
+                    limiters[index % 2].check('typing') for index in range(10)
+                ))
+
+        results = async_to_sync(run)()
+        self.assertEqual(results.count(None), 3)
+        self.assertTrue(all(0 < retry_after <= 3 for retry_after in results if retry_after is not None))
+
+        # Another user has a bucket of their own
+        other = ConnectionRateLimiter(self.user.id + 1)
+        with mock.patch('chat.ratelimit.time.time', return_value=1000.5):
+            self.assertIsNone(async_to_sync(other.check)('typing'))
+
+    @override_settings(CHAT_SETTINGS={
+        'RATE_LIMITS': {'typing': {'connection': {'rate': 1, 'burst': 2}, 'user': {'rate': 1, 'burst': 1}}},
+    })
+    def test_frames_rejected_by_user_limit_keep_connection_tokens(self):
+        limiter = ConnectionRateLimiter(self.user.id)
+        with mock.patch('chat.ratelimit.time.time', return_value=1000.5):
+            self.assertIsNone(async_to_sync(limiter.check)('typing'))
+            self.assertIsNotNone(async_to_sync(limiter.check)('typing'))
+            self.assertEqual(limiter.connection_bucket('typing', {'rate': 1, 'burst': 2}).tokens, 1)
+
+    def test_stats_command_needs_a_shared_cache(self):
+        with self.assertRaisesMessage(CommandError, 'LocMemCache is per process'):
+            call_command('chat_ratelimit_stats')
+
+    def test_user_limit_refills_as_the_window_slides(self):
+        limiter = ConnectionRateLimiter(self.user.id)
+        limit = {'rate': 1, 'burst': 2}
+        consume = async_to_sync(limiter.consume_user_bucket)
+
+        with mock.patch('chat.ratelimit.time.time', return_value=1000.0):
+            self.assertEqual([consume('typing', limit) for _ in range(3)][:2], [None, None])
+        # Half of the previous window has slid out: one more frame fits
+        with mock.patch('chat.ratelimit.time.time', return_value=1003.0):
+            self.assertIsNone(consume('typing', limit))
+            self.assertIsNotNone(consume('typing', limit))
+
+    @override_settings(CHAT_SETTINGS={
+        'RATE_LIMITS': {'typing': {'connection': {'rate': 1, 'burst': 2}}},
+    })
+    def test_over_limit_frames_get_error_frame(self):
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/')
+            communicator.scope['user'] = self.user
+            communicator.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            await communicator.receive_json_from()  # own presence event
+
+            for _ in range(3):
+                await communicator.send_json_to({'type': 'typing', 'is_typing': True})
+            frames = [await communicator.receive_json_from() for _ in range(3)]
+            await communicator.disconnect()
+            return frames
+
+        frames = async_to_sync(run)()
+        self.assertCountEqual([frame['type'] for frame in frames], ['typing', 'typing', 'error'])
+        error = next(frame for frame in frames if frame['type'] == 'error')
+        self.assertEqual(error['code'], 'rate_limited')
+        self.assertEqual(error['frame_type'], 'typing')
+
+
+# Stands in for the Redis layer shared by every worker process
+shared_remote = InMemoryChannelLayer()
+
+
+def get_shared_remote():
+    return shared_remote
+
+
+class WorkerRoutingTests(TestCase):
+
+    def test_room_worker_is_stable_and_in_range(self):
+        workers = [room_worker(room_id, 4) for room_id in range(100)]
+        self.assertEqual(workers, [room_worker(str(room_id), 4) for room_id in range(100)])
+        self.assertEqual(set(workers), {0, 1, 2, 3})
+
+    def test_group_and_path_room_ids(self):
+        self.assertEqual(group_room_id('chat_12'), '12')
+        self.assertEqual(group_room_id('chat_12_s3'), '12')
+        self.assertIsNone(group_room_id('user_12_notifications'))
+        self.assertEqual(path_room_id('/ws/chat/12/'), '12')
+        self.assertIsNone(path_room_id('/ws/notifications/'))
+        self.assertIsNone(path_room_id('/room/12/'))
+
+    def test_pick_worker(self):
+        command = RunWorkersCommand()
+        command.worker_count = 3
+        command.round_robin = iter([2, 0])
+
+        self.assertEqual(command.pick_worker(b'GET /ws/chat/12/ HTTP/1.1\r\n\r\n'), room_worker(12, 3))
+        self.assertEqual(command.pick_worker(b'GET / HTTP/1.1\r\n\r\n'), 2)
+        self.assertEqual(command.pick_worker(b'garbage\r\n\r\n'), 0)
+
+    def test_forwarded_head_drops_client_headers(self):
+        head = (
+            b'GET / HTTP/1.1\r\nHost: chat\r\nX-Forwarded-For: 6.6.6.6\r\n'
+            b'x-forwarded-port: 1\r\nX-Forwarded-Proto: https\r\n\r\n'
+        )
+        lines = forwarded_head(head, ('10.0.0.1', 5000)).split(b'\r\n')
+        headers = dict(line.split(b': ', 1) for line in lines[1:] if line)
+
+        self.assertEqual(lines[0], b'GET / HTTP/1.1')
+        self.assertEqual(parse_x_forwarded_for(headers, original_scheme='http'), (['10.0.0.1', 5000], 'http'))
+
+    def test_refuses_process_local_cache(self):
+        with self.assertRaisesMessage(CommandError, 'REDIS_URL'):
+            call_command('runworkers', '--workers', '2')
+
+
+class AffinityChannelLayerTests(TestCase):
+
+    def create_layer(self, worker_id, remote=None):
+        with mock.patch.dict(os.environ, CHAT_WORKER_ID=str(worker_id), CHAT_WORKER_COUNT='2'):
+            return AffinityChannelLayer(remote=remote)
+
+    def owned_room(self, worker_id):
+        return next(room_id for room_id in range(100) if room_worker(room_id, 2) == worker_id)
+
+    def test_delivers_locally_without_remote(self):
+        async def run():
+            layer = self.create_layer(0)
+            channel = await layer.new_channel()
+            await layer.group_add(f'chat_{self.owned_room(0)}', channel)
+            await layer.group_add('user_1_notifications', channel)
+            await layer.group_send(f'chat_{self.owned_room(0)}', {'type': 'owned'})
+            await layer.group_send('user_1_notifications', {'type': 'unowned'})
+            received = [await layer.receive(channel) for _ in range(2)]
+            await layer.close()
+            return received
+
+        self.assertEqual([message['type'] for message in async_to_sync(run)()], ['owned', 'unowned'])
+
+    def test_owned_groups_skip_remote(self):
+        remote = {'BACKEND': 'chat.tests.get_shared_remote'}
+
+        async def run():
+            await shared_remote.flush()
+            worker = self.create_layer(0, remote)
+            other_worker = self.create_layer(1, remote)
+            owned = f'chat_{self.owned_room(0)}'
+
+            channel = await worker.new_channel()
+            await worker.group_add(owned, channel)
+            await worker.group_send(owned, {'type': 'owned'})
+            owned_message = await worker.receive(channel)
+            remote_groups = set(shared_remote.groups)
+
+            other_channel = await other_worker.new_channel()
+            await other_worker.group_add('user_1_notifications', other_channel)
+            await worker.group_send('user_1_notifications', {'type': 'relayed'})
+            relayed = await asyncio.wait_for(other_worker.receive(other_channel), 1)
+
+            await worker.group_discard(owned, channel)
+            await worker.close()
+            await other_worker.close()
+            return owned_message, remote_groups, relayed
+
+        owned_message, remote_groups, relayed = async_to_sync(run)()
+        self.assertEqual(owned_message['type'], 'owned')
+        self.assertEqual(remote_groups, set())
+        self.assertEqual(relayed['type'], 'relayed')
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class NotificationDigestTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create_user('alice', password='secret')
+        self.recipient = User.objects.create_user('bob', password='secret')
+        self.room = ChatRoom.objects.create(name='team', room_type='group')
+        self.room.participants.add(self.sender, self.recipient)
+
+    def test_missed_messages_fold_into_one_pending_digest(self):
+        for index in range(3):
+            message = Message.objects.create(room=self.room, sender=self.sender, content=f'message {index}')
+            record_missed_message(message, [self.recipient.id])
+
+        digest = NotificationDigest.objects.get(user=self.recipient, room=self.room)
+        self.assertEqual(digest.message_count, 3)
+        self.assertEqual(digest.latest_preview, 'message 2')
+
+        [(user_id, event)] = claim_user_digests(self.recipient.id)
+        self.assertEqual(user_id, self.recipient.id)
+        self.assertEqual(event['count'], 3)
+        self.assertEqual(claim_user_digests(self.recipient.id), [])
+
+    def test_concurrent_first_messages_share_one_digest(self):
+        first, second = (
+            Message.objects.create(room=self.room, sender=self.sender, content=content)
+            for content in ('first', 'second')
+        )
+        open_digest = notifications._open_digest
+
+        def open_after_concurrent_insert(pending, user_id, message, increment):
+            # The other message inserts the digest after this one found none
+            NotificationDigest.objects.create(user_id=user_id, room=self.room, latest_message=first)
+            return open_digest(pending, user_id, message, increment)
+
+        with mock.patch('chat.notifications._open_digest', open_after_concurrent_insert):
+            opened = record_missed_message(second, [self.recipient.id])
+
+        self.assertEqual(opened, [])
+        digest = NotificationDigest.objects.get(user=self.recipient, room=self.room)
+        self.assertEqual((digest.message_count, digest.latest_preview), (2, 'second'))
+
+    @override_settings(CHAT_SETTINGS={**settings.CHAT_SETTINGS, 'PRESENCE_TIMEOUT': 0.6})
+    def test_presence_outlives_its_timeout_while_connected(self):
+        async def run():
+            chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/')
+            chat.scope['user'] = self.recipient
+            chat.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+            await chat.connect()
+            await asyncio.sleep(1.2)
+            connected = await sync_to_async(absent_users)(self.room.id, [self.recipient.id])
+            await chat.disconnect()
+            disconnected = await sync_to_async(absent_users)(self.room.id, [self.recipient.id])
+            return connected, disconnected
+
+        connected, disconnected = async_to_sync(run)()
+        self.assertEqual(connected, [])
+        self.assertEqual(disconnected, [self.recipient.id])
+
+    def test_message_after_claim_opens_new_digest(self):
+        other_room = ChatRoom.objects.create(name='other', room_type='group')
+        for room in (other_room, self.room):
+            message = Message.objects.create(room=room, sender=self.sender, content=room.name)
+            record_missed_message(message, [self.recipient.id])
+
+        with CaptureQueriesContext(connection) as queries:
+            claimed = claim_user_digests(self.recipient.id)
+        if connection.features.has_select_for_update:
+            self.assertIn('FOR UPDATE', queries[0]['sql'])
+        # Oldest update first
+        self.assertEqual([event['room_name'] for _, event in claimed], ['other', 'team'])
+
+        message = Message.objects.create(room=self.room, sender=self.sender, content='late')
+        self.assertEqual(record_missed_message(message, [self.recipient.id]), [self.recipient.id])
+        [(_, event)] = claim_user_digests(self.recipient.id)
+        self.assertEqual((event['count'], event['latest_preview']), (1, 'late'))
+
+    @override_settings(CHAT_SETTINGS={'NOTIFICATION_DIGEST_WINDOW': 0.1})
+    def test_connected_recipient_gets_one_digest(self):
+        async def run():
+            notifications = WebsocketCommunicator(NotificationConsumer.as_asgi(), '/ws/notifications/')
+            notifications.scope['user'] = self.recipient
+            await notifications.connect()
+
+            chat = WebsocketCommunicator(ChatConsumer.as_asgi(), f'/ws/chat/{self.room.id}/')
+            chat.scope['user'] = self.sender
+            chat.scope['url_route'] = {'kwargs': {'room_id': str(self.room.id)}}
+            await chat.connect()
+            await chat.receive_json_from()  # own presence event
+
+            for index in range(2):
+                await chat.send_json_to({'type': 'chat_message', 'message': f'hello {index}'})
+                await chat.receive_json_from()
+
+            digest = await notifications.receive_json_from(timeout=2)
+            no_more = await notifications.receive_nothing(timeout=0.3)
+            await chat.disconnect()
+            await notifications.disconnect()
+            return digest, no_more
+
+        digest, no_more = async_to_sync(run)()
+        self.assertEqual(digest['notification_type'], 'message_digest')
+        self.assertEqual(digest['count'], 2)
+        self.assertEqual(digest['latest_preview'], 'hello 1')
+        self.assertTrue(no_more)
+
+
+@override_settings(SESSION_ENGINE='django.contrib.sessions.backends.cached_db')
+class CachedAuthTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('alice', password='secret')
+        UserProfile.objects.create(user=self.user, theme='light')
+        self.client.force_login(self.user)
+        self.session_key = self.client.session.session_key
+
+    def load_session(self):
+        return import_module(settings.SESSION_ENGINE).SessionStore(self.session_key)
+
+    def test_warm_handshake_does_not_query(self):
+        resolve_user(self.load_session())
+
+        with self.assertNumQueries(0):
+            user = resolve_user(self.load_session())
+            self.assertEqual(user, self.user)
+            self.assertEqual(user.profile.theme, 'light')
+
+    def test_missing_profile_is_cached(self):
+        UserProfile.objects.filter(user=self.user).delete()
+        resolve_user(self.load_session())
+
+        with self.assertNumQueries(0):
+            user = resolve_user(self.load_session())
+            self.assertFalse(hasattr(user, 'profile'))
+
+    def test_status_update_survives_a_concurrently_created_profile(self):
+        consumer = ChatConsumer()
+        consumer.user = self.user
+        update = QuerySet.update
+        # The first UPDATE runs before another socket's INSERT commits
+        updates = iter([lambda queryset, **kwargs: 0, update])
+
+        with mock.patch.object(QuerySet, 'update', lambda queryset, **kwargs: next(updates)(queryset, **kwargs)):
+            async_to_sync(consumer.update_user_status)(True)
+
+        self.assertTrue(UserProfile.objects.get(user=self.user).online)
+
+    def test_profile_change_invalidates_cached_user(self):
+        resolve_user(self.load_session())
+
+        profile = UserProfile.objects.get(user=self.user)
+        profile.theme = 'dark'
+        profile.save()
+
+        self.assertEqual(resolve_user(self.load_session()).profile.theme, 'dark')
+
+    def test_logout_drops_session(self):
+        resolve_user(self.load_session())
+        self.client.logout()
+
+        self.assertFalse(resolve_user(self.load_session()).is_authenticated)
+
+
+class RetentionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='secret')
+        self.bob = User.objects.create_user('bob', password='secret')
+        self.room = ChatRoom.objects.create(room_type='direct', retention_days=30)
+        self.room.participants.add(self.alice, self.bob)
+        record_direct_chat(self.room, self.alice, self.bob)
+
+        old = timezone.now() - timedelta(days=60)
+        for index in range(5):
+            message = Message.objects.create(room=self.room, sender=self.alice, content=f'old {index}')
+            Message.objects.filter(pk=message.pk).update(created=old)
+        Message.objects.create(room=self.room, sender=self.bob, content='recent')
+
+    def test_purges_expired_messages_in_batches(self):
+        batches = []
+        deleted, rooms = Purger(batch_size=2, sleep=0, progress=batches.append).run()
+
+        self.assertEqual((deleted, rooms), (5, 0))
+        self.assertEqual(len(batches), 3)
+        self.assertEqual(list(self.room.messages.values_list('content', flat=True)), ['recent'])
+        self.assertEqual(
+            list(Contact.objects.filter(room=self.room).values_list('message_count', flat=True)),
+            [1, 1],
+        )
+
+    def test_dry_run_deletes_nothing(self):
+        deleted, _ = Purger(batch_size=2, sleep=0, dry_run=True).run()
+
+        self.assertEqual(deleted, 5)
+        self.assertEqual(self.room.messages.count(), 6)
+
+    @override_settings(CHAT_SETTINGS={
+        **settings.CHAT_SETTINGS,
+        'RETENTION': {'group': {'MESSAGE_DAYS': None, 'INACTIVE_ROOM_DAYS': 7}},
+    })
+    def test_deletes_inactive_rooms(self):
+        group = ChatRoom.objects.create(name='old group', room_type='group', is_active=False)
+        Message.objects.create(room=group, sender=self.alice, content='bye')
+        ChatRoom.objects.filter(pk=group.pk).update(modified=timezone.now() - timedelta(days=10))
+
+        deleted, rooms = Purger(sleep=0).run()
+
+        self.assertEqual((deleted, rooms), (6, 1))
+        self.assertFalse(ChatRoom.objects.filter(pk=group.pk).exists())
+        self.assertEqual(Purger(sleep=0, dry_run=True).run(), (0, 0))
+
+    def create_expired_room(self, messages=1):
+        room = ChatRoom.objects.create(name='group', room_type='group', retention_days=30)
+        for index in range(messages):
+            message = Message.objects.create(room=room, sender=self.alice, content=f'old {index}')
+            Message.objects.filter(pk=message.pk).update(created=timezone.now() - timedelta(days=60))
+        return room
+
+    def test_sleeps_after_every_batch(self):
+        self.create_expired_room()
+
+        with mock.patch('chat.retention.time.sleep') as sleep:
+            deleted, _ = Purger(batch_size=10, sleep=0.5).run()
+
+        self.assertEqual(deleted, 6)
+        self.assertEqual(sleep.call_args_list, [mock.call(0.5)] * 2)
+
+    def test_resume_needs_a_shared_cache(self):
+        with self.assertRaisesMessage(CommandError, 'no checkpoint to resume from'):
+            call_command('purge_chat_history', resume=True)
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 6)
+
+    def test_resumes_after_last_purged_room(self):
+        other = self.create_expired_room(messages=2)
+        after_delete = Purger.after_delete
+
+        def fail_on_other_room(purger, room, count):
+            if room == other:
+                raise RuntimeError('interrupted')
+            after_delete(purger, room, count)
+
+        with mock.patch.object(Purger, 'after_delete', fail_on_other_room):
+            with self.assertRaises(RuntimeError):
+                Purger(batch_size=1, sleep=0).run()
+        # The first batch of the interrupted room was already deleted
+        self.assertEqual(other.messages.count(), 1)
+        self.assertEqual(cache.get(CHECKPOINT_KEY), self.room.id)
+
+        deleted, _ = Purger(batch_size=1, sleep=0).run(resume=True)
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual(other.messages.count(), 0)
+        self.assertEqual(self.room.messages.count(), 1)
+        self.assertIsNone(cache.get(CHECKPOINT_KEY))
+
+
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        profiling = override_settings(CHAT_SETTINGS={
+            **settings.CHAT_SETTINGS,
+            'PROFILING': {**settings.CHAT_SETTINGS['PROFILING'], 'DIR': self.directory, 'MAX_FILES': 2},
+        })
+        profiling.enable()
+        self.addCleanup(profiling.disable)
+        self.addCleanup(reset_config)
+
+        self.user = User.objects.create_user('alice', password='secret', is_staff=True)
+        UserProfile.objects.create(user=self.user)
+        self.client.force_login(self.user)
+
+    def test_sampled_requests_write_rotated_profiles(self):
+        set_config(sample_rate=1, slow_query_ms=0)
+        with self.assertLogs('chat.profiling', 'WARNING') as logs:
+            for _ in range(3):
+                self.client.get(reverse('chat:index'))
+        self.assertIn('Slow query in chat:index', logs.output[0])
+
+        profiles = list(self.directory.glob('*.prof'))
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all('-chat_index-' in path.name for path in profiles))
+
+        with self.assertLogs('chat.profiling', 'WARNING'):
+            report = self.client.get(reverse('chat:profiling_summary'), {'handler': 'chat:index'})
+        self.assertContains(report, '== chat_index: ')
+        self.assertContains(report, 'slow queries')
+
+    def test_unsampled_requests_are_not_profiled(self):
+        set_config(sample_rate=0)
+        self.client.get(reverse('chat:index'))
+
+        self.assertEqual(list(self.directory.glob('*.prof')), [])
+        self.assertIn('No profiles recorded', summarize())
+
+    def test_switch_needs_a_shared_cache(self):
+        with self.assertRaisesMessage(CommandError, 'LocMemCache is per process'):
+            call_command('chat_profiling', sample_rate=1)
+        self.assertEqual(cache.get('chat:profiling:config'), None)
+
+        # Showing the settings every process runs with still works
+        output = io.StringIO()
+        call_command('chat_profiling', stdout=output)
+        self.assertIn('Sampling 0% of requests', output.getvalue())
@@ -11,6 +11,9 @@ urlpatterns = [
     path('create-group/', views.create_group_chat, name='create_group_chat'),
     path('profile/', views.update_profile, name='update_profile'),
     path('unread-count/', views.get_unread_count, name='unread_count'),
+    path('contacts/', views.contacts, name='contacts'),
+    path('contacts/search/', views.contact_search, name='contact_search'),
+    path('profiling/', views.profiling_summary, name='profiling_summary'),
     path('i18n/setlang/', set_language, name='set_language'),
     path('login/', views.custom_login, name='login'),
     path('signup/', views.signup, name='signup'),
@@ -1,11 +1,22 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.utils.translation import gettext_lazy as _
-from django.db.models import Q, Count, Max
 from django.core.paginator import Paginator
+from .contacts import get_contact_directory, record_direct_chat, search_users
+from .fanout import is_large_room
+from .fragments import bump_room_version, bump_user_version, fragment_cache_timeout
 from .models import ChatRoom, Message, UserProfile
+from .profiling import summarize
+from .queries import (
+    get_other_participant,
+    load_dashboard_rooms,
+    load_room_messages,
+    load_room_participants,
+    message_block_version,
+)
 
 from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
@@ -19,24 +30,19 @@ def index(request):
     # Get or create user profile
     profile, created = UserProfile.objects.get_or_create(user=request.user)
     
-    # Get all chat rooms for the user
-    chat_rooms = ChatRoom.objects.filter(
-        participants=request.user,
-        is_active=True
-    ).annotate(
-        last_message_time=Max('messages__created'),
-        unread_count=Count('messages', filter=Q(messages__is_read=False) & ~Q(messages__sender=request.user))
-    ).order_by('-last_message_time')
-    
-    # Get other users for starting new chats
-    other_users = User.objects.exclude(id=request.user.id).annotate(
-        has_chat=Count('chat_rooms', filter=Q(chat_rooms__participants=request.user) & Q(chat_rooms__room_type='direct'))
-    )
+    # Get all chat rooms for the user, preloaded for the room rows
+    chat_rooms = load_dashboard_rooms(request.user)
+    
+    # Top contacts come precomputed from the cached contact directory
+    contact_directory = get_contact_directory(request.user)
     
     context = {
         'chat_rooms': chat_rooms,
-        'other_users': other_users,
+        'contacts': contact_directory['recent'],
+        'contact_count': contact_directory['count'],
+        'online_contact_count': sum(contact['online'] for contact in contact_directory['recent']),
         'profile': profile,
+        'fragment_cache_timeout': fragment_cache_timeout(),
     }
     
     return render(request, 'chat/index.html', context)
@@ -50,18 +56,25 @@ def room_detail(request, room_id):
     room = get_object_or_404(ChatRoom, id=room_id, participants=request.user, is_active=True)
     
     # Get messages with pagination
-    messages = room.messages.all().order_by('created')
+    messages = load_room_messages(room)
     paginator = Paginator(messages, 50)
     page_number = request.GET.get('page')
     page_obj = paginator.get_page(page_number)
+    participants = load_room_participants(room)
     
     # Mark unread messages as read
-    room.messages.filter(is_read=False).exclude(sender=request.user).update(is_read=True)
+    if room.messages.filter(is_read=False).exclude(sender=request.user).update(is_read=True):
+        bump_room_version(room.id)
     
     context = {
         'room': room,
         'page_obj': page_obj,
-        'other_participant': room.get_other_participant(request.user),
+        'participants': participants,
+        'other_participant': get_other_participant(room, participants, request.user),
+        # Evaluates the page, the template then renders it without querying again
+        'messages_version': message_block_version(room, page_obj),
+        'can_post': room.can_post(request.user),
+        'fragment_cache_timeout': fragment_cache_timeout(),
     }
     
     return render(request, 'chat/room.html', context)
@@ -84,6 +97,7 @@ def start_chat(request, user_id):
         # Create new chat room
         chat_room = ChatRoom.objects.create(room_type='direct')
         chat_room.participants.add(request.user, other_user)
+        record_direct_chat(chat_room, request.user, other_user)
     
     return redirect('chat:room_detail', room_id=chat_room.id)
 
@@ -99,7 +113,8 @@ def create_group_chat(request):
         
         chat_room = ChatRoom.objects.create(
             name=name,
-            room_type='group'
+            room_type='group',
+            fanout_mode='sharded' if is_large_room(len(participant_ids) + 1) else 'flat'
         )
         chat_room.participants.add(request.user, *participant_ids)
         
@@ -122,6 +137,48 @@ def get_unread_count(request):
     return JsonResponse({'unread_count': count})
 
 
+@staff_member_required
+def profiling_summary(request):
+    """
+    Plain text summary of the recorded profiles and slow queries
+    """
+    try:
+        limit = int(request.GET.get('limit', 25))
+    except ValueError:
+        limit = 25
+    report = summarize(handler=request.GET.get('handler') or None, limit=limit)
+    return HttpResponse(report, content_type='text/plain; charset=utf-8')
+
+
+@login_required
+def contacts(request):
+    """
+    API endpoint for the user's recent and frequent contacts
+    """
+    contact_directory = get_contact_directory(request.user)
+    return JsonResponse(contact_directory)
+
+
+@login_required
+def contact_search(request):
+    """
+    API endpoint for prefix search over users, paginated by cursor
+    """
+    try:
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+    except ValueError:
+        limit = 20
+    
+    results, next_cursor = search_users(
+        request.user,
+        request.GET.get('q', ''),
+        cursor=request.GET.get('cursor'),
+        limit=limit,
+    )
+    
+    return JsonResponse({'results': results, 'next_cursor': next_cursor})
+
+
 @login_required
 def update_profile(request):
     """
@@ -136,6 +193,7 @@ def update_profile(request):
             profile.profile_picture = request.FILES['profile_picture']
         
         profile.save()
+        bump_user_version(request.user.id)
         
         # Set language in session
         request.session['django_language'] = profile.language
@@ -0,0 +1,58 @@
+import os
+import re
+import zlib
+
+from django.conf import settings
+
+
+# Caches that are not shared between processes
+PROCESS_LOCAL_CACHES = {
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+}
+ROOM_GROUP_RE = re.compile(r'^chat_(?P<room_id>\w+?)(?:_s\d+)?$')
+ROOM_PATH_RE = re.compile(r'^/ws/chat/(?P<room_id>\w+)/')
+
+
+def current_worker():
+    """
+    (worker_id, worker_count) of this process when started by runworkers,
+    (None, None) otherwise
+    """
+    worker_id = os.environ.get('CHAT_WORKER_ID')
+    worker_count = os.environ.get('CHAT_WORKER_COUNT')
+    if worker_id is None or worker_count is None:
+        return None, None
+    return int(worker_id), int(worker_count)
+
+
+def room_worker(room_id, worker_count):
+    """
+    The worker every socket of a room is routed to
+    """
+    return zlib.crc32(str(room_id).encode()) % worker_count
+
+
+def group_room_id(group_name):
+    """
+    Room id of a chat room group (flat or shard), or None for other groups
+    """
+    match = ROOM_GROUP_RE.match(group_name)
+    return match.group('room_id') if match else None
+
+
+def path_room_id(path):
+    """
+    Room id of a chat WebSocket path, or None for any other request
+    """
+    match = ROOM_PATH_RE.match(path)
+    return match.group('room_id') if match else None
+
+
+def process_local_cache():
+    """
+    The default cache backend when it isn't shared with other processes,
+    None otherwise
+    """
+    backend = settings.CACHES['default']['BACKEND']
+    return backend if backend in PROCESS_LOCAL_CACHES else None
@@ -1,19 +1,28 @@
 import os
 from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_app.settings')
+
+# Set up Django before anything below imports models
+http_application = get_asgi_application()
+
 from channels.routing import ProtocolTypeRouter, URLRouter
-from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
+from django.conf import settings
+from chat.auth import CachedAuthMiddlewareStack
 from chat.routing import websocket_urlpatterns
+from chat.static_app import StaticFilesApp
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_app.settings')
+if settings.CHAT_SETTINGS.get('SERVE_STATIC'):
+    http_application = StaticFilesApp(http_application)
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": http_application,
     "websocket": AllowedHostsOriginValidator(
-        AuthMiddlewareStack(
+        CachedAuthMiddlewareStack(
             URLRouter(
                 websocket_urlpatterns
             )
         )
     ),
-})
\ No newline at end of file
+})
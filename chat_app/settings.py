@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'chat.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
@@ -79,6 +80,17 @@ TEMPLATES = [
         },
     },
 ]
+
+# Compiled templates are kept in memory outside development
+if not DEBUG:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 ASGI_APPLICATION = 'chat_app.asgi.application'
 WSGI_APPLICATION = 'chat_app.wsgi.application'
 
@@ -103,23 +115,99 @@ DATABASES = {
 # }
 
 
+# Shared Redis for the cache and channel layer; without it the cache is
+# per process, which runworkers refuses to start with
+REDIS_URL = config('REDIS_URL', default='')
+
 # Channels layer configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],  # Update with your Redis config
-            "capacity": 1500,  # default value
-            "expiry": 60,  # default value
-        },
+REDIS_CHANNEL_LAYER = {
+    'BACKEND': 'channels_redis.core.RedisChannelLayer',
+    'CONFIG': {
+        "hosts": [REDIS_URL or ('127.0.0.1', 6379)],
+        "capacity": 1500,  # default value
+        "expiry": 60,  # default value
     },
 }
 
+if config('CHAT_WORKER_COUNT', default=''):
+    # Started by runworkers: room traffic stays inside the owning worker,
+    # Redis only carries what has to cross workers
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'chat.layers.AffinityChannelLayer',
+            'CONFIG': {
+                'remote': REDIS_CHANNEL_LAYER,
+                'capacity': 1500,
+                'expiry': 60,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': REDIS_CHANNEL_LAYER,
+    }
+
+# Cache (shared Redis in production, per-process memory otherwise)
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+
 # Chat settings
 CHAT_SETTINGS = {
     'MESSAGE_HISTORY_LIMIT': 50,
     'ONLINE_TIMEOUT': 60,  # seconds
     'TYPING_TIMEOUT': 3,   # seconds
+    'LARGE_ROOM_THRESHOLD': 500,  # participants before a group uses sharded fan-out
+    'FANOUT_SHARDS': 8,
+    'CONTACTS_TOP_N': 5,
+    'CONTACTS_CACHE_TIMEOUT': 60,  # seconds
+    'NOTIFICATION_DIGEST_WINDOW': 5,  # seconds messages to an absent user are batched for
+    'PRESENCE_TIMEOUT': 3600,  # seconds a room/notification socket counts as connected
+    'AUTH_CACHE_TIMEOUT': 300,  # seconds a WebSocket handshake may reuse a cached user
+    'FRAGMENT_CACHE_TIMEOUT': 60,  # seconds, rendered room rows and message blocks
+    # Token buckets per WebSocket frame type: rate is tokens per second,
+    # burst the bucket size; 'user' is shared across all of a user's sockets
+    'RATE_LIMITS': {
+        'chat_message': {
+            'connection': {'rate': 2, 'burst': 10},
+            'user': {'rate': 5, 'burst': 20},
+        },
+        'typing': {
+            'connection': {'rate': 2, 'burst': 5},
+            'user': {'rate': 4, 'burst': 10},
+        },
+        'read_receipt': {
+            'connection': {'rate': 20, 'burst': 50},
+            'user': {'rate': 40, 'burst': 100},
+        },
+    },
+    # Per room type: days messages are kept and days an inactive room is
+    # kept before it is deleted; None keeps them forever.
+    # ChatRoom.retention_days overrides MESSAGE_DAYS for a single room.
+    'RETENTION': {
+        'direct': {'MESSAGE_DAYS': None, 'INACTIVE_ROOM_DAYS': None},
+        'group': {'MESSAGE_DAYS': None, 'INACTIVE_ROOM_DAYS': None},
+    },
+    # Runtime switch with `manage.py chat_profiling`; these are the defaults.
+    # SAMPLE_RATE is the fraction of requests and frames profiled,
+    # SLOW_QUERY_MS the query duration logged as slow (None disables)
+    'PROFILING': {
+        'SAMPLE_RATE': config('PROFILE_SAMPLE_RATE', default=0, cast=float),
+        'SLOW_QUERY_MS': None,
+        'DIR': BASE_DIR / 'profiles',
+        'MAX_FILES': 200,
+    },
+    'SERVE_STATIC': config('SERVE_STATIC', default=not DEBUG, cast=bool),  # serve STATIC_ROOT from the ASGI app
 }
 
 
@@ -145,6 +233,22 @@ STATIC_URL = 'static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# Hashed, minified and precompressed static files (run collectstatic first)
+STATICFILES_MANIFEST = config('STATICFILES_MANIFEST', default=not DEBUG, cast=bool)
+
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': (
+            'chat.storage.CompressedManifestStaticFilesStorage'
+            if STATICFILES_MANIFEST
+            else 'django.contrib.staticfiles.storage.StaticFilesStorage'
+        ),
+    },
+}
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
@@ -152,6 +256,14 @@ MEDIA_ROOT = BASE_DIR / 'media'
 CRISPY_ALLOWED_TEMPLATE_PACKS = "tailwind"
 CRISPY_TEMPLATE_PACK = "tailwind"
 
+# Sessions are read through the cache when it is shared between processes,
+# a per-process cache would keep logged out sessions alive on other workers;
+# 'signed_cookies' avoids the store entirely
+SESSION_ENGINE = config(
+    'SESSION_ENGINE',
+    default='django.contrib.sessions.backends.cached_db' if REDIS_URL else 'django.contrib.sessions.backends.db',
+)
+
 # Authentication
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'chat:index'
@@ -213,6 +213,10 @@ class ChatRoom {
             case 'connection_status':
                 this.handleConnectionStatus(data);
                 break;
+                
+            case 'error':
+                this.handleError(data);
+                break;
         }
     }
 
@@ -435,6 +439,20 @@ class ChatRoom {
         }
     }
 
+    handleError(data) {
+        if (data.code === 'rate_limited') {
+            if (data.frame_type === 'chat_message') {
+                this.showMessageStatus(`You are sending messages too quickly. Try again in ${Math.ceil(data.retry_after)}s.`, 'error');
+            }
+            return;
+        }
+        if (data.code === 'read_only') {
+            this.showMessageStatus('Only broadcasters can post in this room.', 'error');
+            return;
+        }
+        console.error('WebSocket error frame:', data);
+    }
+
     showMessageStatus(text, type = 'info') {
         const statusElement = document.getElementById('message-status');
         const statusText = document.getElementById('status-text');